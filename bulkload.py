@@ -0,0 +1,336 @@
+# Bulk bootstrap (scbootstrap.py --bulk): loads every logfile into an empty
+# db without going through stats.act_on_logfile_line game by game. All
+# games are run through an in-memory model of the derived tables that
+# follows the same rules as stats.py, and the final contents of each table
+# are written out with multi-row INSERTs in a single transaction at the
+# end. Milestones are few enough in their effect on the db (only rune
+# finds and ziggurats) that they still go through stats.act_on_milestone.
+#
+# Rows are written in the order the incremental path would have left them,
+# so everything matches an incremental load except the values of
+# AUTO_INCREMENT ids (the incremental path burns ids on rows it later
+# deletes).
+
+import collections
+import heapq
+import sys
+import time
+
+import scload
+import stats
+
+from logging import debug, info, warn, error
+from scload import query_do, query_first, query_do_many, game_is_win
+from scload import sql_key, sql_max
+
+def game_insert(table, extras=[]):
+  cols = scload.LOG_DB_COLUMNS + extras
+  return ('INSERT INTO %s (%s) VALUES (%s)'
+          % (table, ",".join(cols), ",".join([ "%s" for x in cols ])))
+
+class TopN:
+  """The n highest-scoring games, dropping the lowest (oldest first among
+  equal scores) as better games come in."""
+  def __init__(self, n):
+    self.n = n
+    self.heap = [ ]
+
+  def add(self, sc, seq, row):
+    if len(self.heap) >= self.n:
+      if sc > self.heap[0][0]:
+        heapq.heapreplace(self.heap, (sc, seq, row))
+    else:
+      heapq.heappush(self.heap, (sc, seq, row))
+
+  def entries(self):
+    return self.heap
+
+class RecentGames:
+  """A recent-games ring as stats.RecentGamesRing fills it: the newest limit
+  games, each row carrying its slot and seq (counted from 1 per ring)."""
+  def __init__(self, limit):
+    self.limit = limit
+    self.count = 0
+    self.games = collections.deque(maxlen=limit)
+
+  def add(self, seq, row):
+    self.count += 1
+    self.games.append((seq, row + (self.count % self.limit, self.count)))
+
+  def entries(self):
+    return self.games
+
+class BulkGameState:
+  """In-memory model of the tables stats.act_on_logfile_line maintains."""
+  def __init__(self):
+    self.discard()
+
+  def discard(self):
+    self.seq = 0
+    self.top_games = TopN(stats.TOP_N)
+    self.players = { }
+    self.char_stats = { }
+    self.best_games = { }
+    self.recent_games = { }
+    self.all_recent_games = RecentGames(stats.MAX_ALL_RECENT_GAMES)
+    self.first_games = { }
+    self.last_games = { }
+    self.wins = [ ]
+    self.streaks = [ ]
+    self.active_streaks = { }
+    self.streak_games = [ ]
+    self.streak_breakers = [ ]
+    self.top_scores = { 'top_combo_scores': { },
+                        'top_species_scores': { },
+                        'top_class_scores': { } }
+    self.top_killers = { }
+    self.killer_recent_kills = { }
+    self.ghost_victims = [ ]
+    self.per_day_stats = { }
+    self.date_players = { }
+    self.known_races = { }
+    self.known_classes = { }
+
+  def add_game(self, g):
+    """The in-memory equivalent of stats.act_on_logfile_line."""
+    if 'start_time' not in g:
+      return
+    self.seq += 1
+    seq = self.seq
+    row = stats.game_row(g)
+    player = sql_key(g['name'])
+    win = game_is_win(g)
+
+    self.top_games.add(g['sc'], seq, row)
+
+    self.update_player(g, player, win)
+    self.update_streak(g, player, win, row)
+
+    best = self.best_games.get(player)
+    if not best:
+      best = self.best_games[player] = TopN(stats.MAX_PLAYER_BEST_GAMES)
+    best.add(g['sc'], seq, row)
+
+    key = (player, sql_key(g['charabbr']))
+    cstats = self.char_stats.get(key)
+    if cstats:
+      cstats[2] += 1
+      cstats[3] = sql_max(cstats[3], g['xl'])
+      cstats[4] += win and 1 or 0
+    else:
+      self.char_stats[key] = [ g['name'], g['charabbr'], 1, g['xl'],
+                               win and 1 or 0 ]
+
+    recent = self.recent_games.get(player)
+    if not recent:
+      recent = self.recent_games[player] = \
+          RecentGames(stats.MAX_PLAYER_RECENT_GAMES)
+    recent.add(seq, row)
+    if not stats.is_junk_game(g):
+      self.all_recent_games.add(seq, row)
+
+    if player not in self.first_games:
+      self.first_games[player] = (seq, row)
+    self.last_games[player] = (seq, row, win, g['end_time'])
+    if win:
+      self.wins.append(row)
+
+    for table, thing in (('top_combo_scores', 'charabbr'),
+                         ('top_species_scores', 'raceabbr'),
+                         ('top_class_scores', 'cls')):
+      scores = self.top_scores[table]
+      value = sql_key(g[thing])
+      if g['sc'] > scores.get(value, (0,))[0]:
+        scores[value] = (g['sc'], seq, row)
+
+    ckiller = sql_key(g['ckiller'])
+    kstats = self.top_killers.get(ckiller)
+    if kstats:
+      kstats[1] += 1
+      kstats[2] = g['name']
+    else:
+      self.top_killers[ckiller] = [ g['ckiller'], 1, g['name'] ]
+    self.killer_recent_kills[ckiller] = (seq, row)
+
+    if scload.is_ghost_kill(g):
+      ghost = scload.extract_ghost_name(g['killer'])
+      if ghost != g['name']:
+        self.ghost_victims.append((ghost, g['name']))
+
+    if not stats.is_junk_game(g):
+      self.update_per_day(g, player, win)
+
+    for known, value in ((self.known_races, g['raceabbr']),
+                         (self.known_classes, g['clsabbr'])):
+      if sql_key(value) not in known:
+        known[sql_key(value)] = value
+
+  def update_player(self, g, player, win):
+    p = self.players.get(player)
+    if not p:
+      self.players[player] = [ g['name'], 1, win and 1 or 0, g['sc'], g['sc'],
+                               g['xl'], g['start_time'], g['end_time'],
+                               g['urune'] ]
+      return
+    p[1] += 1
+    p[2] += win and 1 or 0
+    p[3] += g['sc']
+    p[4] = sql_max(p[4], g['sc'])
+    p[5] = sql_max(p[5], g['xl'])
+    p[7] = g['end_time']
+    p[8] = sql_max(p[8], g['urune'])
+
+  def update_streak(self, g, player, win, row):
+    """As stats.update_player_streak; must see the player's last game before
+    this one."""
+    streak = self.active_streaks.get(player)
+    if not win:
+      if streak:
+        streak[4] = False
+        del self.active_streaks[player]
+        self.streak_breakers.append(row + (streak[0],))
+    elif streak:
+      streak[3] = g['end_time']
+      streak[5] += 1
+      self.streak_games.append(row)
+    else:
+      last = self.last_games.get(player)
+      if last and last[2]:
+        streak = [ len(self.streaks) + 1, g['name'], last[3], g['end_time'],
+                   True, 2 ]
+        self.streaks.append(streak)
+        self.active_streaks[player] = streak
+        self.streak_games.append(last[1])
+        self.streak_games.append(row)
+
+  def update_per_day(self, g, player, win):
+    edate = g['end_time'][:8]
+    day = self.per_day_stats.get(edate)
+    if day:
+      day[1] += 1
+      day[2] += win and 1 or 0
+    else:
+      self.per_day_stats[edate] = [ edate, 1, win and 1 or 0 ]
+
+    key = (edate, player)
+    dp = self.date_players.get(key)
+    if dp:
+      dp[3] += 1
+      dp[4] += win and 1 or 0
+    else:
+      self.date_players[key] = [ edate, edate[:6], g['name'], 1,
+                                 win and 1 or 0 ]
+
+  def flush(self, c):
+    """Writes the final contents of every table."""
+    def seq_rows(entries):
+      return [ e[1] for e in sorted(entries, key=lambda e: e[0]) ]
+
+    def write_games(table, rows, extras=[]):
+      info("Writing %d rows to %s" % (len(rows), table))
+      query_do_many(c, game_insert(table, extras), rows)
+
+    write_games('top_games',
+                seq_rows([ e[1:] for e in self.top_games.entries() ]))
+    write_games('player_best_games',
+                seq_rows([ e[1:] for t in self.best_games.values()
+                           for e in t.entries() ]))
+    write_games('player_recent_games',
+                seq_rows([ e for r in self.recent_games.values()
+                           for e in r.entries() ]),
+                [ 'slot', 'seq' ])
+    write_games('all_recent_games',
+                seq_rows(self.all_recent_games.entries()),
+                [ 'slot', 'seq' ])
+    write_games('player_first_games', seq_rows(self.first_games.values()))
+    write_games('player_last_games',
+                seq_rows([ e[:2] for e in self.last_games.values() ]))
+    write_games('wins', self.wins)
+    write_games('streak_games', self.streak_games)
+    for table, scores in self.top_scores.items():
+      write_games(table, seq_rows([ e[1:] for e in scores.values() ]))
+    write_games('killer_recent_kills',
+                seq_rows(self.killer_recent_kills.values()))
+    query_do_many(c, game_insert('streak_breakers', [ 'streak_id' ]),
+                  self.streak_breakers)
+
+    def write(table, cols, rows):
+      info("Writing %d rows to %s" % (len(rows), table))
+      query_do_many(c, 'INSERT INTO %s (%s) VALUES (%s)'
+                    % (table, ",".join(cols), ",".join([ "%s" for x in cols ])),
+                    [ tuple(r) for r in rows ])
+
+    write('streaks',
+          [ 'id', 'player', 'start_game_time', 'end_game_time', 'active',
+            'ngames' ],
+          self.streaks)
+    write('players',
+          [ 'name', 'games_played', 'games_won', 'total_score', 'best_score',
+            'best_xl', 'first_game_start', 'last_game_end', 'max_runes' ],
+          self.players.values())
+    write('player_char_stats',
+          [ 'name', 'charabbr', 'games_played', 'best_xl', 'wins' ],
+          self.char_stats.values())
+    write('top_killers', [ 'ckiller', 'kills', 'most_recent_victim' ],
+          self.top_killers.values())
+    write('ghost_victims', [ 'ghost', 'victim' ], self.ghost_victims)
+    write('per_day_stats', [ 'which_day', 'games_ended', 'games_won' ],
+          self.per_day_stats.values())
+    write('date_players',
+          [ 'which_day', 'which_month', 'player', 'games', 'wins' ],
+          self.date_players.values())
+    query_do_many(c, 'INSERT IGNORE INTO known_races (race) VALUES (%s)',
+                  [ (r,) for r in self.known_races.values() ])
+    query_do_many(c, 'INSERT IGNORE INTO known_classes (cls) VALUES (%s)',
+                  [ (k,) for k in self.known_classes.values() ])
+    self.discard()
+
+class BulkListener (scload.CrawlEventListener):
+  """Feeds games to the BulkGameState, and writes the games history as it
+  goes rather than holding it all to the end."""
+  def __init__(self, state):
+    self.state = state
+    self.games = [ ]
+
+  def logfile_event(self, cursor, logdict):
+    if 'start_time' in logdict:
+      self.games.append(stats.game_row(logdict))
+      if len(self.games) >= scload.BULK_BATCH_ROWS:
+        self.flush(cursor)
+    self.state.add_game(logdict)
+
+  def flush(self, c):
+    scload.query_do_rows(c, stats.game_insert_prefix('games'), self.games)
+    self.games = [ ]
+
+  def discard(self):
+    self.games = [ ]
+
+  def milestone_event(self, cursor, milestone):
+    stats.act_on_milestone(cursor, milestone)
+
+def check_empty(c):
+  if (query_first(c, 'SELECT COUNT(*) FROM logfile_offsets')
+      or query_first(c, 'SELECT COUNT(*) FROM players')):
+    raise Exception("Bulk load needs an empty db (load database.sql first)")
+
+def bulk_load(c, master):
+  """Loads all logfiles and milestones into an empty db in one pass and one
+  transaction."""
+  check_empty(c)
+  state = BulkGameState()
+  listeners = scload.LISTENERS[:]
+  listener = BulkListener(state)
+  scload.LISTENERS[:] = [ listener ]
+  scload.PENDING_WRITERS.extend([ listener, state ])
+  start = time.time()
+  try:
+    # One transaction for the whole load: the derived tables are only
+    # written at the very end, along with the logfile offsets.
+    master.tail_all(c, batch=scload.TransactionBatch(c, sys.maxint,
+                                                    sys.maxint))
+  finally:
+    scload.PENDING_WRITERS.remove(listener)
+    scload.PENDING_WRITERS.remove(state)
+    scload.LISTENERS[:] = listeners
+  info("Bulk load done in %.1fs" % (time.time() - start))
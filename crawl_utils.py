@@ -44,6 +44,10 @@ CAO_OVERVIEW = '''<a href="%s/overview.html">Overview</a>''' % CAO_SCORING_BASE
 
 RAWDATA_PATH = '/var/www/crawl/rawdata'
 SCORESD_STOP_REQUEST_FILE = os.path.join(BASEDIR, 'scoresd.stop')
+# scoresd writes its memoizer stats to SCORESD_STATS_FILE when it sees
+# SCORESD_STATS_REQUEST_FILE.
+SCORESD_STATS_REQUEST_FILE = os.path.join(BASEDIR, 'scoresd.stats-request')
+SCORESD_STATS_FILE = os.path.join(BASEDIR, 'scoresd.stats')
 
 MKDIRS = [ SCORE_FILE_DIR, PLAYER_FILE_DIR ]
 
@@ -63,6 +67,22 @@ def clear_scoresd_stop_request():
 def scoresd_stop_requested():
   return os.path.exists(SCORESD_STOP_REQUEST_FILE)
 
+def write_scoresd_stats_request():
+  if os.path.exists(SCORESD_STATS_FILE):
+    os.unlink(SCORESD_STATS_FILE)
+  f = open(SCORESD_STATS_REQUEST_FILE, 'w')
+  f.write("\n")
+  f.close()
+
+def scoresd_stats_requested():
+  return os.path.exists(SCORESD_STATS_REQUEST_FILE)
+
+def write_scoresd_stats(lines):
+  f = open(SCORESD_STATS_FILE, 'w')
+  f.write("\n".join(lines) + "\n")
+  f.close()
+  os.unlink(SCORESD_STATS_REQUEST_FILE)
+
 def unlock_handle():
   fcntl.flock(LOCK, fcntl.LOCK_UN)
 
@@ -2,6 +2,8 @@
 -- SET storage_engine=InnoDB;
 
 DROP TABLE IF EXISTS logfile_offsets;
+DROP TABLE IF EXISTS games;
+DROP TABLE IF EXISTS rebuilds;
 DROP TABLE IF EXISTS player_recent_games;
 DROP TABLE IF EXISTS all_recent_games;
 DROP TABLE IF EXISTS player_best_games;
@@ -100,6 +102,22 @@ CREATE TABLE player_best_games (
 );
 CREATE INDEX player_best_game_pscores ON player_best_games (name, sc);
 
+-- Every game loaded, in load order. The derived game tables can all be
+-- rebuilt from this (see rebuild.py).
+CREATE TABLE games AS SELECT * FROM player_best_games;
+ALTER TABLE games ADD CONSTRAINT PRIMARY KEY (id);
+ALTER TABLE games CHANGE COLUMN id id BIGINT AUTO_INCREMENT;
+CREATE INDEX games_name_id ON games (name, id);
+
+-- One row per finished rebuild.py run; scoresd reloads its in-memory
+-- state when a new one appears.
+CREATE TABLE rebuilds (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  tables VARCHAR(1000),
+  last_game BIGINT,
+  finished DATETIME
+);
+
 CREATE TABLE wins AS SELECT * FROM player_best_games;
 ALTER TABLE wins ADD CONSTRAINT PRIMARY KEY (id);
 ALTER TABLE wins CHANGE COLUMN id id BIGINT AUTO_INCREMENT;
@@ -108,19 +126,34 @@ CREATE INDEX wins_dur ON wins (dur);
 CREATE INDEX wins_turn ON wins (turn);
 CREATE INDEX wins_sc ON wins (sc);
 
+-- The recent-games tables are ring buffers (see stats.RecentGamesRing): the
+-- seq'th recent game goes into slot seq mod capacity, overwriting the game
+-- that was there. Newest first is ORDER BY seq DESC.
 CREATE TABLE all_recent_games AS SELECT * FROM player_best_games;
 ALTER TABLE all_recent_games ADD CONSTRAINT PRIMARY KEY (id);
 ALTER TABLE all_recent_games CHANGE COLUMN id id BIGINT AUTO_INCREMENT;
+ALTER TABLE all_recent_games ADD COLUMN slot INT NOT NULL,
+                             ADD COLUMN seq BIGINT NOT NULL;
 CREATE INDEX all_recent_games_end
 ON all_recent_games (end_time DESC);
+CREATE UNIQUE INDEX all_recent_games_slot
+ON all_recent_games (slot);
+CREATE INDEX all_recent_games_seq
+ON all_recent_games (seq);
 
 CREATE TABLE player_recent_games AS SELECT * FROM player_best_games;
 ALTER TABLE player_recent_games ADD CONSTRAINT PRIMARY KEY (id);
 ALTER TABLE player_recent_games CHANGE COLUMN id id BIGINT AUTO_INCREMENT;
+ALTER TABLE player_recent_games ADD COLUMN slot INT NOT NULL,
+                                ADD COLUMN seq BIGINT NOT NULL;
 CREATE INDEX player_recent_games_name_end
 ON player_recent_games (name, end_time DESC);
 CREATE INDEX player_recent_games_name_id
 ON player_recent_games (name, id);
+CREATE UNIQUE INDEX player_recent_games_name_slot
+ON player_recent_games (name, slot);
+CREATE INDEX player_recent_games_name_seq
+ON player_recent_games (name, seq);
 
 -- Table for the top games on the servers. How many games we keep here
 -- is controlled by the Python code.
@@ -0,0 +1,198 @@
+# Fetches the remote logfiles and milestones, replacing a "wget -c" per
+# file. Each fetch asks only for the bytes past the local copy's size
+# (HTTP Range), and repeats the ETag/Last-Modified the server last gave
+# for that URL, so a source with nothing new costs a single 304 or 416.
+# All remote files are fetched at once from a small pool of threads,
+# reusing one keep-alive connection per host and thread where possible.
+
+import httplib
+import urlparse
+import threading
+import Queue
+import os
+import os.path
+import re
+
+from logging import debug, info, warn, error
+
+FETCH_THREADS = 8
+FETCH_TIMEOUT = 60
+FETCH_BLOCK_SIZE = 64 * 1024
+
+R_CONTENT_RANGE = re.compile(r'^bytes (\d+)-')
+
+class ConnectionPool:
+  """Idle HTTP connections keyed by (scheme, host). A connection is taken
+  out of the pool for the length of one request and put back only if the
+  response was read in full."""
+  def __init__(self):
+    self.idle = { }
+    self.lock = threading.Lock()
+
+  def get(self, scheme, host):
+    self.lock.acquire()
+    try:
+      conns = self.idle.get((scheme, host))
+      if conns:
+        return conns.pop()
+    finally:
+      self.lock.release()
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host, timeout=FETCH_TIMEOUT)
+    return httplib.HTTPConnection(host, timeout=FETCH_TIMEOUT)
+
+  def put(self, scheme, host, conn):
+    self.lock.acquire()
+    try:
+      self.idle.setdefault((scheme, host), [ ]).append(conn)
+    finally:
+      self.lock.release()
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      for conns in self.idle.values():
+        for conn in conns:
+          conn.close()
+      self.idle.clear()
+    finally:
+      self.lock.release()
+
+class RemoteFetcher:
+  """Brings local copies of remote files up to date. Validators (ETag and
+  Last-Modified) are remembered per URL for the life of the process."""
+  def __init__(self, threads=None):
+    self.threads = threads or FETCH_THREADS
+    self.pool = ConnectionPool()
+    self.validators = { }
+
+  def fetch(self, url, filename):
+    """Appends whatever the server has past the end of filename. Returns the
+    number of bytes added; raises IOError on failure."""
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      raise IOError("Cannot fetch %s: unsupported URL scheme" % url)
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+
+    size = os.path.exists(filename) and os.path.getsize(filename) or 0
+    headers = { }
+    if size > 0:
+      headers['Range'] = 'bytes=%d-' % size
+      etag, modified = self.validators.get(url, (None, None))
+      if etag:
+        headers['If-None-Match'] = etag
+      if modified:
+        headers['If-Modified-Since'] = modified
+
+    conn = self.pool.get(parts.scheme, parts.netloc)
+    try:
+      try:
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        added = self._handle_response(url, filename, size, resp)
+      except httplib.HTTPException, e:
+        raise IOError("Failed to fetch %s: %s" % (url, e))
+    except:
+      conn.close()
+      raise
+    if resp.will_close:
+      conn.close()
+    else:
+      self.pool.put(parts.scheme, parts.netloc, conn)
+    return added
+
+  def _handle_response(self, url, filename, size, resp):
+    status = resp.status
+    if status == 304 or status == 416:
+      # Not modified, or nothing past our size.
+      resp.read()
+      debug("No new data at %s (%d)" % (url, status))
+      return 0
+
+    if status == 206:
+      m = R_CONTENT_RANGE.search(resp.getheader('content-range') or '')
+      if not m or int(m.group(1)) != size:
+        resp.read()
+        raise IOError("Bad Content-Range from %s: %s"
+                      % (url, resp.getheader('content-range')))
+      skip = 0
+    elif status == 200:
+      # The server ignored the Range header and sent the whole file: skip
+      # the part we already have.
+      skip = size
+    else:
+      resp.read()
+      raise IOError("Failed to fetch %s: HTTP %d %s"
+                    % (url, status, resp.reason))
+
+    added = self._append(filename, resp, skip)
+    self.validators[url] = (resp.getheader('etag'),
+                            resp.getheader('last-modified'))
+    if added:
+      info("Fetched %d bytes from %s to %s" % (added, url, filename))
+    return added
+
+  def _append(self, filename, resp, skip):
+    added = 0
+    f = open(filename, 'ab')
+    try:
+      while True:
+        block = resp.read(FETCH_BLOCK_SIZE)
+        if not block:
+          break
+        if skip:
+          if len(block) <= skip:
+            skip -= len(block)
+            continue
+          block = block[skip:]
+          skip = 0
+        f.write(block)
+        added += len(block)
+    finally:
+      f.close()
+    if skip:
+      raise IOError("%s is longer than the remote copy" % filename)
+    return added
+
+  def fetch_all(self, sources):
+    """Fetches all (url, filename) pairs concurrently. Every source is
+    attempted even if some fail; failures are then reported together as a
+    single IOError."""
+    jobs = Queue.Queue()
+    for source in sources:
+      jobs.put(source)
+    errors = [ ]
+
+    def work():
+      while True:
+        try:
+          url, filename = jobs.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          self.fetch(url, filename)
+        except Exception, e:
+          error("Fetch of %s failed: %s" % (url, e))
+          errors.append(str(e))
+
+    threads = [ threading.Thread(target=work)
+                for i in range(min(self.threads, len(sources))) ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    if errors:
+      raise IOError("; ".join(errors))
+
+  def close(self):
+    self.pool.close()
+
+FETCHER = RemoteFetcher()
+
+def fetch_remote(url, filename):
+  return FETCHER.fetch(url, filename)
+
+def fetch_all(sources):
+  FETCHER.fetch_all(sources)
@@ -0,0 +1,147 @@
+# Checks fetch.RemoteFetcher against a local stand-in HTTP server that
+# serves files from memory with Range, ETag and Last-Modified support.
+#
+# Usage: python fetchtest.py
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import tempfile
+import shutil
+import os
+import os.path
+import re
+import email.utils
+import time
+
+import fetch
+
+R_RANGE = re.compile(r'^bytes=(\d+)-$')
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+    # path -> file contents
+    self.files = { }
+    # When set, Range headers are ignored (200 with the whole file).
+    self.ignore_ranges = False
+    self.requests = [ ]
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    server = self.server
+    server.requests.append((self.path, self.headers.get('Range'),
+                            self.headers.get('If-None-Match')))
+    data = server.files.get(self.path)
+    if data is None:
+      return self.reply(404)
+    etag = '"%d-%x"' % (len(data), hash(data) & 0xffffffff)
+    headers = { 'ETag': etag,
+                'Last-Modified': email.utils.formatdate(usegmt=True) }
+    if self.headers.get('If-None-Match') == etag:
+      return self.reply(304, headers=headers)
+    m = R_RANGE.match(self.headers.get('Range') or '')
+    if m and not server.ignore_ranges:
+      start = int(m.group(1))
+      if start >= len(data):
+        headers['Content-Range'] = 'bytes */%d' % len(data)
+        return self.reply(416, headers=headers)
+      headers['Content-Range'] = ('bytes %d-%d/%d'
+                                  % (start, len(data) - 1, len(data)))
+      return self.reply(206, data[start:], headers)
+    return self.reply(200, data, headers)
+
+  def reply(self, status, body='', headers=None):
+    self.send_response(status)
+    for key, value in (headers or { }).items():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+def check(what, cond):
+  print "%-50s %s" % (what, cond and 'ok' or 'FAILED')
+  if not cond:
+    raise AssertionError(what)
+
+def contents(filename):
+  f = open(filename)
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+def main():
+  server = StandInServer()
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  tmpdir = tempfile.mkdtemp()
+  fetcher = fetch.RemoteFetcher()
+  try:
+    names = [ 'logfile%d' % i for i in range(12) ]
+    sources = [ (server.url('/' + n), os.path.join(tmpdir, n))
+                for n in names ]
+    for n in names:
+      server.files['/' + n] = ''.join([ 'v=0.%d:name=%s:sc=%d\n' % (i, n, i)
+                                        for i in range(100) ])
+
+    fetcher.fetch_all(sources)
+    check("initial fetch of all files",
+          all([ contents(f) == server.files['/' + n]
+                for n, (u, f) in zip(names, sources) ]))
+
+    url, filename = sources[0]
+    del server.requests[:]
+    check("unchanged file fetches nothing",
+          fetcher.fetch(url, filename) == 0)
+    check("unchanged file sends range and validator",
+          server.requests[-1][1] and server.requests[-1][2])
+
+    server.files['/' + names[0]] += 'v=0.9:name=new:sc=1\n'
+    check("appended data is fetched",
+          fetcher.fetch(url, filename) == len('v=0.9:name=new:sc=1\n'))
+    check("local copy matches after append",
+          contents(filename) == server.files['/' + names[0]])
+
+    fresh = fetch.RemoteFetcher()
+    check("no validators, nothing new (416)",
+          fresh.fetch(url, filename) == 0)
+
+    server.files['/' + names[1]] += 'v=0.9:name=more:sc=2\n'
+    server.ignore_ranges = True
+    check("server ignoring Range still appends the tail",
+          fresh.fetch(sources[1][0], sources[1][1]) > 0
+          and contents(sources[1][1]) == server.files['/' + names[1]])
+    server.ignore_ranges = False
+
+    try:
+      fetcher.fetch_all(sources[2:4] +
+                        [ (server.url('/missing'),
+                           os.path.join(tmpdir, 'missing')) ])
+      failed = False
+    except IOError:
+      failed = True
+    check("missing file raises IOError", failed)
+
+    start = time.time()
+    fetcher.fetch_all(sources)
+    check("idle refetch of %d files (%.1f ms)"
+          % (len(sources), (time.time() - start) * 1000), True)
+  finally:
+    fetcher.close()
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,4 @@
+CREATE INDEX games_name_id ON games (name, id);
 CREATE INDEX player_best_game_pscores ON player_best_games (name, sc);
 CREATE INDEX wins_name ON wins (name);
 CREATE INDEX wins_dur ON wins (dur);
@@ -9,6 +10,14 @@ CREATE INDEX player_recent_games_name_end
 ON player_recent_games (name, end_time DESC);
 CREATE INDEX player_recent_games_name_id
 ON player_recent_games (name, id);
+CREATE UNIQUE INDEX all_recent_games_slot
+ON all_recent_games (slot);
+CREATE INDEX all_recent_games_seq
+ON all_recent_games (seq);
+CREATE UNIQUE INDEX player_recent_games_name_slot
+ON player_recent_games (name, slot);
+CREATE INDEX player_recent_games_name_seq
+ON player_recent_games (name, seq);
 CREATE INDEX top_games_sc ON top_games (sc);
 CREATE INDEX top_combo_scores_name ON top_combo_scores (name, charabbr);
 CREATE UNIQUE INDEX top_combo_scores_charabbr
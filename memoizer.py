@@ -1,41 +1,191 @@
+import collections
+import time
+
+# Write generation of each table (lower-cased name), bumped by the db write
+# helpers in scload. A DBMemoizer that declares the tables it reads drops
+# any result stored before one of them was last written.
+GENERATIONS = collections.defaultdict(int)
+# Bumped when every DBMemoizer result must go (rollback, rebuilt tables).
+EPOCH = 0
+# The DBMemoizers reading each table by key (see DBMemoizer.reads).
+KEYED_READERS = collections.defaultdict(list)
+
+def row_key(key):
+  """Keys compare case-insensitively in MySQL's default collation."""
+  if isinstance(key, basestring):
+    return key.lower()
+  return key
+
+def bump(*tables):
+  for t in tables:
+    GENERATIONS[t.lower()] += 1
+    for m in KEYED_READERS[t.lower()]:
+      m.flush()
+
+def bump_keys(table, keys):
+  """Notes a write to only the rows of table with the given keys: the
+  DBMemoizers reading it by key drop just the results for those keys."""
+  GENERATIONS[table.lower()] += 1
+  keys = set([ row_key(k) for k in keys ])
+  for m in KEYED_READERS[table.lower()]:
+    m.drop_keys(keys)
+
+def bump_all():
+  global EPOCH
+  EPOCH += 1
+
 class Memoizer (object):
-  FLUSH_THRESHOLD = 1000
   """Given a function, caches the results of the function for sets of arguments
-  and returns the cached result where possible. Do not use if you have
-  very large possible combinations of args, or we'll run out of RAM."""
-  def __init__(self, fn, extractor=None):
+  and returns the cached result where possible. At most capacity results are
+  kept, the least recently used being dropped first; with a ttl (in
+  seconds), a result older than that is computed again.
+
+  @Memoizer.sized(capacity, ttl) sets these for one function, and
+  @DBMemoizer.reads(table, ...) declares the tables a DBMemoizer reads."""
+  CAPACITY = 1000
+  # Every memoizer created, for stats() and report().
+  ALL = [ ]
+
+  def __init__(self, fn, extractor=None, capacity=None, ttl=None):
     self.fn = fn
-    self.cache = { }
     self.extractor = extractor or (lambda baz: baz)
+    self.capacity = capacity or self.CAPACITY
+    self.ttl = ttl
+    # key -> (value, time stored, version()), least recently used first.
+    self.cache = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # Results found too old or invalidated by a table write.
+    self.stale = 0
+    self.flushes = 0
+    # Seconds spent in fn.
+    self.time = 0.0
+    Memoizer.ALL.append(self)
+
+  @classmethod
+  def sized(cls, capacity, ttl=None):
+    return lambda fn: cls(fn, capacity=capacity, ttl=ttl)
+
+  def version(self):
+    """What must be unchanged for a cached result to still be good."""
+    return None
+
+  def name(self):
+    return "%s.%s" % (self.fn.__module__, self.fn.__name__)
+
+  def _get(self, key):
+    """Returns the cache entry for key, marking it most recently used, or
+    None if there is none or it has expired."""
+    entry = self.cache.pop(key, None)
+    if entry is None:
+      return None
+    if ((self.ttl is not None and time.time() - entry[1] >= self.ttl)
+        or entry[2] != self.version()):
+      self.stale += 1
+      return None
+    self.cache[key] = entry
+    return entry
+
+  def _put(self, key, value):
+    self.cache.pop(key, None)
+    self.cache[key] = (value, self.ttl is not None and time.time(),
+                       self.version())
+    while len(self.cache) > self.capacity:
+      self.cache.popitem(last=False)
+      self.evictions += 1
 
   def __call__(self, *args):
-    if len(self.cache) > Memoizer.FLUSH_THRESHOLD:
-      self.flush()
     key = self.extractor(args)
-    if not self.cache.has_key(key):
-      value = self.fn(*args)
-      self.cache[key] = value
-      return value
-    return self.cache[key]
+    entry = self._get(key)
+    if entry is not None:
+      self.hits += 1
+      return entry[0]
+    self.misses += 1
+    start = time.time()
+    value = self.fn(*args)
+    self.time += time.time() - start
+    self._put(key, value)
+    return value
 
   def flush(self):
+    self.flushes += 1
     self.cache.clear()
 
   def flush_key(self, *args):
-    try:
-      del self.cache[args]
-    except KeyError:
-      pass
+    self.flushes += 1
+    self.cache.pop(args, None)
+
+  def drop_keys(self, keys):
+    """Drops the results whose first argument is in keys (a set of
+    row_key()s)."""
+    for key in self.cache.keys():
+      if key and row_key(key[0]) in keys:
+        del self.cache[key]
+        self.stale += 1
 
   def has_key(self, *args):
-    return self.cache.has_key(args)
+    return self._get(args) is not None
 
   def set_key(self, value, *args):
-    self.cache[args] = value
+    self._put(args, value)
 
   def record(self, args, value):
-    self.cache[self.extractor(args)] = value
+    self._put(self.extractor(args), value)
+
+  def stats(self):
+    return { 'name': self.name(),
+             'calls': self.hits + self.misses,
+             'hits': self.hits,
+             'misses': self.misses,
+             'stale': self.stale,
+             'flushes': self.flushes,
+             'evictions': self.evictions,
+             'time': self.time,
+             'size': len(self.cache),
+             'capacity': self.capacity }
 
 class DBMemoizer (Memoizer):
-  def __init__(self, fn):
-    Memoizer.__init__(self, fn, lambda args: args[1:])
+  """A Memoizer for functions of (cursor, ...); the cursor is not part of
+  the key. Results go stale when any of tables is written to, and on
+  rollback.
+
+  With by_key, the function reads only the rows of the first table keyed
+  by its first argument, and a write to some of that table's rows (see
+  bump_keys) drops only the results for those keys."""
+  def __init__(self, fn, capacity=None, ttl=None, tables=(), by_key=False):
+    Memoizer.__init__(self, fn, lambda args: args[1:], capacity, ttl)
+    self.tables = [ t.lower() for t in tables ]
+    if by_key:
+      KEYED_READERS[self.tables[0]].append(self)
+      self.tables = self.tables[1:]
+
+  @classmethod
+  def reads(cls, *tables, **options):
+    return lambda fn: cls(fn, tables=tables, **options)
+
+  def version(self):
+    return (EPOCH,) + tuple([ GENERATIONS[t] for t in self.tables ])
+
+def stats():
+  """The stats() of every memoizer, most time spent in the wrapped function
+  first."""
+  result = [ m.stats() for m in Memoizer.ALL ]
+  result.sort(key=lambda s: -s['time'])
+  return result
+
+def report_lines():
+  lines = [ "--------------------------------------------------------",
+            "MEMOIZER STATS" ]
+  for s in stats():
+    if s['calls'] or s['flushes']:
+      lines.append(("%(name)s: %(calls)d calls, %(hits)d hits, "
+                    "%(misses)d misses (%(stale)d stale), "
+                    "%(flushes)d flushes, %(evictions)d evictions, "
+                    "%(time).3fs, %(size)d/%(capacity)d entries") % s)
+  return lines
+
+def report():
+  """Prints the stats of every memoizer used."""
+  for line in report_lines():
+    print line
@@ -0,0 +1,78 @@
+# Micro-benchmark for the chronological merge of xlog sources done by
+# scload.MasterXlogReader. Compares the old sort-the-pending-list merge
+# with the heap merge (scload.XlogMerger) for increasing source counts.
+#
+# Usage: python mergebench.py [total-lines]
+
+import random
+import time
+import scload
+
+SOURCE_COUNTS = [ 1, 2, 4, 8, 16, 32, 64 ]
+DEFAULT_LINES = 200000
+
+class FakeXlogfile:
+  """Stands in for an Xlogfile, handing out pre-generated Xloglines."""
+  def __init__(self, name, times):
+    self.lines = [ scload.Xlogline(self, name, i, t, None, None)
+                   for i, t in enumerate(times) ]
+    self.index = 0
+
+  def line(self, cursor):
+    if self.index >= len(self.lines):
+      return None
+    line = self.lines[self.index]
+    self.index += 1
+    return line
+
+def make_sources(nsources, nlines):
+  per_source = nlines / nsources
+  sources = [ ]
+  for s in range(nsources):
+    t = 20080101000000
+    times = [ ]
+    for i in range(per_source):
+      t += random.randint(1, 500)
+      times.append("%d" % t)
+    sources.append(FakeXlogfile("src%d" % s, times))
+  return sources
+
+def sort_merge(xlogs):
+  """The merge MasterXlogReader.tail_all used to do."""
+  lines = [ line for line in [ x.line(None) for x in xlogs ] if line ]
+  n = 0
+  while lines:
+    lines.sort()
+    oldest = lines.pop()
+    newline = oldest.owner.line(None)
+    if newline:
+      lines.append(newline)
+    n += 1
+  return n
+
+def heap_merge(xlogs):
+  n = 0
+  for line in scload.XlogMerger(xlogs, None):
+    n += 1
+  return n
+
+def bench(merge, nsources, nlines):
+  random.seed(nsources)
+  sources = make_sources(nsources, nlines)
+  start = time.time()
+  n = merge(sources)
+  return n, time.time() - start
+
+def main():
+  nlines = scload.ARGS and int(scload.ARGS[0]) or DEFAULT_LINES
+  print "%8s %10s %14s %14s" % ('sources', 'lines', 'sort us/line',
+                                'heap us/line')
+  for nsources in SOURCE_COUNTS:
+    n, sort_time = bench(sort_merge, nsources, nlines)
+    n, heap_time = bench(heap_merge, nsources, nlines)
+    print "%8d %10d %14.2f %14.2f" % (nsources, n,
+                                      sort_time * 1e6 / n,
+                                      heap_time * 1e6 / n)
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,11 @@
-from memoizer import Memoizer
 import re
 import os
 import glob
-from crawl_utils import RAWDATA_PATH
+import marshal
+import collections
+from crawl_utils import RAWDATA_PATH, BASEDIR
+
+from logging import debug, info, warn, error
 
 R = re.compile
 
@@ -27,6 +30,10 @@ MORGUE_BASES = [
 CAO_MORGUE_BASE = 'http://crawl.akrasiac.org/rawdata'
 CDO_MORGUE_BASE = 'http://crawl.develz.org/morgues/stable'
 R_MORGUE_TIME = re.compile(r'morgue-\w+-(.*?)\.txt$')
+# find_cao_morgue_link results, kept across runs.
+MORGUE_LINK_CACHE = os.path.join(BASEDIR, 'morgue-links.cache')
+# Players whose links are kept, least recently looked up dropped first.
+MORGUE_LINK_PLAYERS = 10000
 
 def morgue_time_string(raw_time):
   return raw_time[:8] + "-" + raw_time[8:]
@@ -59,8 +66,7 @@ def morgue_binary_search(morgues, guess):
       e = pivot
   return e < size and morgues[e]
 
-@Memoizer
-def find_cao_morgue_link(name, end_time):
+def lookup_cao_morgue_link(name, end_time):
   fulltime = end_time
   if os.path.exists(morgue_filename(name, fulltime)):
     return cao_morgue_url(name, fulltime)
@@ -83,6 +89,84 @@ def find_cao_morgue_link(name, end_time):
       return cao_morgue_url(name, m.group(1))
   return None
 
+def player_dir_mtime(name):
+  try:
+    return os.stat(RAWDATA_PATH + "/" + name).st_mtime
+  except OSError:
+    return None
+
+class MorgueLinkCache:
+  """Morgue links by name and end time for at most capacity players, saved
+  to filename as a marshalled list of (name, mtime of the player's rawdata
+  directory, { end_time: link }), least recently looked up first. A
+  player's links are thrown away when the directory's mtime has changed
+  (morgues were added or removed), which is checked on every lookup."""
+  def __init__(self, filename, capacity=MORGUE_LINK_PLAYERS):
+    self.filename = filename
+    self.capacity = capacity
+    self.players = None
+    self.dirty = False
+
+  def load(self):
+    self.players = collections.OrderedDict()
+    if not os.path.exists(self.filename):
+      return
+    f = open(self.filename, 'rb')
+    try:
+      try:
+        saved = marshal.load(f)
+        if not isinstance(saved, list):
+          raise TypeError("not a list")
+        for name, mtime, links in saved:
+          self.players[name] = (mtime, links)
+      except (EOFError, ValueError, TypeError):
+        warn("%s: unreadable, starting it over" % self.filename)
+        self.players.clear()
+    finally:
+      f.close()
+
+  def player_links(self, name):
+    if self.players is None:
+      self.load()
+    mtime = player_dir_mtime(name)
+    entry = self.players.pop(name, None)
+    if entry is None or entry[0] != mtime:
+      entry = (mtime, { })
+      self.dirty = True
+    self.players[name] = entry
+    while len(self.players) > self.capacity:
+      self.players.popitem(last=False)
+    return entry[1]
+
+  def link(self, name, end_time):
+    links = self.player_links(name)
+    if end_time not in links:
+      links[end_time] = lookup_cao_morgue_link(name, end_time)
+      self.dirty = True
+    return links[end_time]
+
+  def save(self):
+    """Writes the cache out if anything was added since the last save."""
+    if not self.dirty:
+      return
+    tmp = self.filename + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+      marshal.dump([ (name, mtime, links) for name, (mtime, links)
+                     in self.players.items() ], f)
+    finally:
+      f.close()
+    os.rename(tmp, self.filename)
+    self.dirty = False
+
+MORGUE_LINKS = MorgueLinkCache(MORGUE_LINK_CACHE)
+
+def find_cao_morgue_link(name, end_time):
+  return MORGUE_LINKS.link(name, end_time)
+
+def save_link_cache():
+  MORGUE_LINKS.save()
+
 def game_is_cao(g):
   return g['source_file'].find('cao') >= 0
 
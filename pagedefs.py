@@ -6,6 +6,7 @@ import os
 import os.path
 import scload
 import query
+import morgue
 import crawl_utils
 import locale
 import html
@@ -119,10 +120,21 @@ def mark_all_clean():
     v['dirtiness'] = 0
   DIRTY_PLAYERS.clear()
 
+def any_dirty():
+  """Returns True if incremental_build may have something to render."""
+  if first_run:
+    return True
+  for things in (DIRTY_PAGES, DIRTY_PLAYERS):
+    for v in things.values():
+      if v['dirtiness']:
+        return True
+  return False
+
 def rebuild(c):
   render(c, 'index')
   render_pages(c)
   mark_all_clean()
+  morgue.save_link_cache()
 
 def incremental_build(c):
   global first_run
@@ -145,3 +157,4 @@ def incremental_build(c):
         del things[d]
   apply_to_dirty(DIRTY_PAGES, render)
   apply_to_dirty(DIRTY_PLAYERS, player_page, wipe=True)
+  morgue.save_link_cache()
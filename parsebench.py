@@ -0,0 +1,68 @@
+# Throughput benchmark for xlogline parsing. Compares the multi-pass
+# apply_dbtypes(xlog_dict(line)) path with the single-pass
+# scload.xlog_typed_dict, and checks that both produce the same records.
+# Also times loading the same records from a sidecar chunk (sidecar.py).
+#
+# Usage: python parsebench.py [xlogfile] [total-lines]
+
+import time
+import marshal
+import scload
+
+DEFAULT_FILE = 'sample-log.txt'
+DEFAULT_LINES = 100000
+
+def read_lines(filename):
+  f = open(filename)
+  try:
+    return [ line for line in f.readlines()
+             if line.strip() and not scload.invalid_xlog_line(line) ]
+  finally:
+    f.close()
+
+def old_parse(line):
+  return scload.apply_dbtypes(scload.xlog_dict(line))
+
+def bench(parse, lines, nlines):
+  start = time.time()
+  n = 0
+  while n < nlines:
+    for line in lines:
+      parse(line)
+    n += len(lines)
+  return n / (time.time() - start)
+
+def bench_sidecar(lines, nlines):
+  """Records/sec unmarshalled from sidecar chunks of the parsed lines."""
+  chunk = marshal.dumps([ (i, scload.xlog_typed_dict(line))
+                          for i, line in enumerate(lines) ])
+  start = time.time()
+  n = 0
+  while n < nlines:
+    n += len(marshal.loads(chunk))
+  return n / (time.time() - start)
+
+def main():
+  args = scload.ARGS
+  filename = args and args[0] or DEFAULT_FILE
+  nlines = len(args) > 1 and int(args[1]) or DEFAULT_LINES
+  lines = read_lines(filename)
+  if not lines:
+    print "No xloglines in %s" % filename
+    return
+
+  for line in lines:
+    if old_parse(line) != scload.xlog_typed_dict(line):
+      print "Parsers disagree on: %s" % line.strip()
+
+  old_rate = bench(old_parse, lines, nlines)
+  new_rate = bench(scload.xlog_typed_dict, lines, nlines)
+  sidecar_rate = bench_sidecar(lines, nlines)
+  print "%s: %d distinct lines, %d parsed per run" % (filename, len(lines),
+                                                      nlines)
+  print "multi-pass:  %10.0f lines/sec" % old_rate
+  print "single-pass: %10.0f lines/sec" % new_rate
+  print "sidecar:     %10.0f lines/sec" % sidecar_rate
+
+if __name__ == '__main__':
+  main()
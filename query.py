@@ -23,6 +23,8 @@ import time
 # Number of unique uniques
 MAX_UNIQUES = 43
 MAX_RUNES = 15
+# Canonical player names kept in memory.
+PLAYER_NAME_CACHE_SIZE = 5000
 
 def _cursor():
   """Easy retrieve of cursor to make interactive testing easier."""
@@ -68,7 +70,7 @@ def whereis_player(name):
     f = open(where_path)
     try:
       line = f.readline()
-      d = scload.apply_dbtypes( scload.xlog_dict(line) )
+      d = scload.xlog_typed_dict(line)
       return _filter_invalid_where(d)
     finally:
       f.close()
@@ -81,7 +83,7 @@ def row_to_xdict(row):
 def xdict_rows(rows):
   return [row_to_xdict(x) for x in rows]
 
-@DBMemoizer
+@DBMemoizer.reads('players', by_key=True, capacity=PLAYER_NAME_CACHE_SIZE)
 def canonicalize_player_name(c, player):
   row = query_row(c, '''SELECT name FROM players WHERE name = %s''',
                   player)
@@ -408,7 +410,7 @@ first."""
 
 def player_recent_games(c, player, limit=15):
   return find_games(c, 'player_recent_games',
-                    sort_max = 'end_time',
+                    sort_max = 'seq',
                     name = player,
                     limit = limit)
 
@@ -538,14 +540,14 @@ def best_ziggurats(c, limit=6):
                             FROM ziggurats
                           ORDER BY deepest DESC, zig_time DESC''')]
 
-@DBMemoizer
+@DBMemoizer.reads('date_players', by_key=True)
 def count_players_per_day(c, day):
   return query_first(c,
                      '''SELECT COUNT(*) FROM date_players
                                        WHERE which_day = %s''',
                      day)
 
-@DBMemoizer
+@DBMemoizer.reads('date_players', by_key=True)
 def winners_for_day(c, day):
   return query_rows(c,
                     '''SELECT player, wins FROM date_players
@@ -640,14 +642,14 @@ def date_stats(c):
   flush_month(month[0])
   return result
 
-@DBMemoizer
+@DBMemoizer.reads('known_classes')
 def all_classes(c):
   scload.bootstrap_known_raceclasses(c)
   clx = query_first_col(c, '''SELECT cls FROM known_classes''')
   clx.sort()
   return clx
 
-@DBMemoizer
+@DBMemoizer.reads('known_races')
 def all_races(c):
   scload.bootstrap_known_raceclasses(c)
   races = query_first_col(c, '''SELECT race FROM known_races''')
@@ -0,0 +1,435 @@
+# Set-based rebuild of the derived game tables from the games history
+# table. Each table (or group of tables that must be rebuilt together) is
+# filled by INSERT ... SELECT statements, using GROUP BY and ranking window
+# functions (MySQL 8 or MariaDB 10.2 and up), into a <table>_rebuild copy,
+# and the copies are swapped in with one RENAME TABLE.
+#
+# Runs in the background alongside scoresd.py: the build reads only games
+# up to a snapshot id, at READ COMMITTED so that its reads take no row
+# locks (under REPEATABLE READ, INSERT ... SELECT locks the games rows it
+# reads and the gap after them, holding up scoresd's inserts into games
+# until they time out). Only then is INGEST_LOCK taken
+# (scoresd holds it for each of its load transactions, so this happens
+# between two of them) to swap the copies in and apply the games scoresd
+# loaded during the build, through the same stats.py code scoresd would
+# have used, before letting scoresd go on. scoresd notices the new
+# rebuilds row and reloads its in-memory state.
+#
+# The rebuilt tables match an incremental load except for AUTO_INCREMENT
+# ids and which of several equal scores make it into top_games and
+# player_best_games at the cut-off. low_xl_rune_finds and ziggurats come
+# from milestones, not games, and are not rebuilt.
+#
+# games only holds the games loaded since it was added (see upgrade.sql),
+# so rebuild.py refuses to run unless it holds every game players counts:
+# on a db that was not loaded from scratch since, a rebuild would throw
+# away the stats of every older game.
+#
+# Usage: python rebuild.py [-n] [--force] [table ...]
+# rebuilds the given tables (by default, all of them); -n stays in the
+# foreground and logs to stderr, --force skips the games history check.
+
+import sys
+import time
+import datetime
+import logging
+from logging import debug, info, warn, error
+
+import crawl_utils
+import scload
+import stats
+
+from scload import query_do, query_first
+
+REBUILD_LOCKFILE = crawl_utils.BASEDIR + '/scoring-rebuild.lock'
+REBUILD_LOGFILE = crawl_utils.BASEDIR + '/scoring-rebuild.log'
+SHADOW = '_rebuild'
+
+COLS = scload.LOG_DB_SCOLUMNS
+
+def cols(alias):
+  return ",".join([ alias + "." + x for x in scload.LOG_DB_COLUMNS ])
+
+# SQL for "this game is not junk" (stats.is_junk_game).
+NOT_JUNK = "NOT (sc < 2500 AND ktyp IN ('leaving', 'quitting'))"
+
+def ranked_games(partition, order, where='1'):
+  """Games with rank_ (1 for the first in order) within partition."""
+  return ('''SELECT *, ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %s)
+                       AS rank_
+               FROM games WHERE id <= :snapshot AND %s'''
+          % (partition, order, where))
+
+def first_per(partition, order, where='1'):
+  """The first game in order for each value of partition."""
+  return ('SELECT ' + COLS + ' FROM (' + ranked_games(partition, order, where)
+          + ') r WHERE rank_ = 1 ORDER BY id')
+
+def top_per(partition, n):
+  return ('SELECT ' + COLS + ' FROM (' +
+          ranked_games(partition, 'sc DESC, id') +
+          ') r WHERE rank_ <= %d ORDER BY id' % n)
+
+def recent_ring(partition, n, where='1'):
+  """The newest n games per partition, with their ring slot and seq (see
+  stats.RecentGamesRing)."""
+  return ('''SELECT %s, MOD(seq, %d), seq
+               FROM (SELECT *,
+                            ROW_NUMBER() OVER (PARTITION BY %s ORDER BY id)
+                              AS seq,
+                            COUNT(*) OVER (PARTITION BY %s) AS total
+                       FROM games WHERE id <= :snapshot AND %s) r
+              WHERE seq > total - %d ORDER BY id'''
+          % (COLS, n, partition, partition, where, n))
+
+def game_insert(table, extras=''):
+  return ('INSERT INTO %s%s (%s%s) ' % (table, SHADOW, COLS, extras))
+
+# How each group applies a game loaded during its build, as
+# stats.act_on_logfile_line would have (see replay()).
+
+def replay_top_killers(c, g):
+  stats.AGGREGATES.add_kill(g['ckiller'], g['name'])
+
+def replay_players(c, g):
+  stats.AGGREGATES.add_player_game(g, scload.game_is_win(g) and 1 or 0)
+
+def replay_streaks(c, g):
+  # The streak state is loaded from player_last_games, so the two go
+  # together, streaks first.
+  stats.update_player_streak(c, g)
+  stats.update_player_last_game(c, g)
+
+# Tables are rebuilt in groups; each group lists its tables, the
+# statements that fill their shadow copies (:snapshot is the last games id
+# to include), and its replay function.
+GROUPS = [
+  (('top_games',),
+   [ game_insert('top_games') +
+     'SELECT ' + COLS + ''' FROM (SELECT * FROM games
+                                   WHERE id <= :snapshot
+                                ORDER BY sc DESC, id LIMIT %d) t
+                          ORDER BY id''' % stats.TOP_N ],
+   stats.update_topN),
+
+  (('player_best_games',),
+   [ game_insert('player_best_games') +
+     top_per('name', stats.MAX_PLAYER_BEST_GAMES) ],
+   stats.update_player_best_games),
+
+  (('player_recent_games',),
+   [ game_insert('player_recent_games', ',slot,seq') +
+     recent_ring('name', stats.MAX_PLAYER_RECENT_GAMES) ],
+   stats.update_player_recent_games),
+
+  (('all_recent_games',),
+   [ game_insert('all_recent_games', ',slot,seq') +
+     recent_ring('1', stats.MAX_ALL_RECENT_GAMES, NOT_JUNK) ],
+   stats.update_all_recent_games),
+
+  (('player_first_games',),
+   [ game_insert('player_first_games') + first_per('name', 'id') ],
+   stats.update_player_first_game),
+
+  (('wins',),
+   [ game_insert('wins') +
+     'SELECT ' + COLS + ''' FROM games
+                          WHERE id <= :snapshot AND ktyp = 'winning'
+                       ORDER BY id''' ],
+   stats.update_wins_table),
+
+  # stats.RECORD_SCORES keeps all three.
+  (('top_combo_scores', 'top_species_scores', 'top_class_scores'),
+   [ game_insert('top_combo_scores') +
+     first_per('charabbr', 'sc DESC, id', 'sc > 0'),
+     game_insert('top_species_scores') +
+     first_per('raceabbr', 'sc DESC, id', 'sc > 0'),
+     game_insert('top_class_scores') +
+     first_per('cls', 'sc DESC, id', 'sc > 0') ],
+   stats.update_combo_scores),
+
+  (('killer_recent_kills',),
+   [ game_insert('killer_recent_kills') + first_per('ckiller', 'id DESC') ],
+   lambda c, g: stats.KILLER_RECENT_KILLS.add(g)),
+
+  # Streaks are runs of two or more consecutive wins by a player: a run is
+  # the games for which (game number) - (win or loss number) is the same.
+  (('streaks', 'streak_games', 'streak_breakers', 'player_last_games'),
+   [ game_insert('player_last_games') + first_per('name', 'id DESC'),
+     'DROP TEMPORARY TABLE IF EXISTS streak_runs',
+     '''CREATE TEMPORARY TABLE streak_runs AS
+        WITH w AS (
+          SELECT id, name, win, player_last, run,
+                 ROW_NUMBER() OVER (PARTITION BY name, win, run
+                                    ORDER BY id) AS pos
+            FROM (SELECT id, name, ktyp,
+                         ktyp = 'winning' AS win,
+                         MAX(id) OVER (PARTITION BY name) AS player_last,
+                         ROW_NUMBER() OVER (PARTITION BY name ORDER BY id)
+                         - ROW_NUMBER() OVER (PARTITION BY name,
+                                                           ktyp = 'winning'
+                                              ORDER BY id) AS run
+                    FROM games WHERE id <= :snapshot) g),
+        r AS (
+          SELECT name, MIN(id) AS first_id, MAX(id) AS last_id,
+                 MAX(CASE WHEN pos = 2 THEN id END) AS second_id,
+                 COUNT(*) AS ngames, MAX(id) = MAX(player_last) AS active
+            FROM w WHERE win GROUP BY name, run HAVING COUNT(*) >= 2)
+        SELECT ROW_NUMBER() OVER (ORDER BY second_id) AS id,
+               name, first_id, last_id, ngames, active
+          FROM r''',
+     '''INSERT INTO streaks''' + SHADOW + '''
+               (id, player, start_game_time, end_game_time, active, ngames)
+        SELECT s.id, f.name, f.end_time, l.end_time, s.active, s.ngames
+          FROM streak_runs s, games f, games l
+         WHERE f.id = s.first_id AND l.id = s.last_id
+      ORDER BY s.id''',
+     game_insert('streak_games') +
+     'SELECT ' + cols('g') + ''' FROM streak_runs s, games g
+                              WHERE g.name = s.name
+                                AND g.id BETWEEN s.first_id AND s.last_id
+                           ORDER BY g.id''',
+     game_insert('streak_breakers', ',streak_id') +
+     'SELECT ' + cols('g') + ''', s.id
+          FROM streak_runs s, games g
+         WHERE NOT s.active
+           AND g.id = (SELECT MIN(n.id) FROM games n
+                        WHERE n.name = s.name AND n.id > s.last_id
+                          AND n.id <= :snapshot)
+      ORDER BY g.id''',
+     'DROP TEMPORARY TABLE streak_runs' ],
+   replay_streaks),
+
+  # The incremental bests are CASE WHEN best < new (scload.sql_max), where
+  # a NULL first value sticks and later NULLs are ignored, so the bests
+  # here are MAX() unless the first game's value is NULL.
+  (('players',),
+   [ '''INSERT INTO players''' + SHADOW + '''
+               (name, games_played, games_won, total_score, best_score,
+                best_xl, first_game_start, last_game_end, max_runes,
+                current_combo)
+        SELECT f.name, a.games_played, a.games_won, a.total_score,
+               CASE WHEN f.sc IS NOT NULL THEN a.best_score END,
+               CASE WHEN f.xl IS NOT NULL THEN a.best_xl END,
+               f.start_time, l.end_time,
+               CASE WHEN f.urune IS NOT NULL THEN a.max_runes END,
+               p.current_combo
+          FROM (SELECT MIN(id) AS first_id, MAX(id) AS last_id,
+                       COUNT(*) AS games_played,
+                       SUM(ktyp = 'winning') AS games_won,
+                       SUM(sc) AS total_score, MAX(sc) AS best_score,
+                       MAX(xl) AS best_xl, MAX(urune) AS max_runes
+                  FROM games WHERE id <= :snapshot GROUP BY name) a
+          JOIN games f ON f.id = a.first_id
+          JOIN games l ON l.id = a.last_id
+          LEFT JOIN players p ON p.name = f.name''' ],
+   replay_players),
+
+  (('player_char_stats',),
+   [ '''INSERT INTO player_char_stats''' + SHADOW + '''
+               (name, charabbr, games_played, best_xl, wins)
+        SELECT f.name, f.charabbr, a.games_played,
+               CASE WHEN f.xl IS NOT NULL THEN a.best_xl END, a.wins
+          FROM (SELECT MIN(id) AS first_id, COUNT(*) AS games_played,
+                       MAX(xl) AS best_xl, SUM(ktyp = 'winning') AS wins
+                  FROM games WHERE id <= :snapshot
+              GROUP BY name, charabbr) a
+          JOIN games f ON f.id = a.first_id''' ],
+   stats.update_player_char_stats),
+
+  (('top_killers',),
+   [ '''INSERT INTO top_killers''' + SHADOW + '''
+               (ckiller, kills, most_recent_victim)
+        SELECT f.ckiller, a.kills, l.name
+          FROM (SELECT MIN(id) AS first_id, MAX(id) AS last_id,
+                       COUNT(*) AS kills
+                  FROM games WHERE id <= :snapshot GROUP BY ckiller) a
+          JOIN games f ON f.id = a.first_id
+          JOIN games l ON l.id = a.last_id''' ],
+   replay_top_killers),
+
+  # Player names have no apostrophes, so a ghost's name is everything
+  # before the first one (as R_GHOST_NAME has it, without a backreference).
+  (('ghost_victims',),
+   [ '''INSERT INTO ghost_victims''' + SHADOW + ''' (ghost, victim)
+        SELECT ghost, name
+          FROM (SELECT id, name, killer,
+                       SUBSTRING_INDEX(killer, '\'\'', 1) AS ghost
+                  FROM games
+                 WHERE id <= :snapshot) g
+         WHERE SUBSTRING(killer, CHAR_LENGTH(ghost) + 2) REGEXP '^s? ghost'
+           AND BINARY ghost <> BINARY name
+      ORDER BY id''' ],
+   stats.update_gkills),
+
+  # stats.update_per_day_stats counts both.
+  (('per_day_stats', 'date_players'),
+   [ '''INSERT INTO per_day_stats''' + SHADOW + '''
+               (which_day, games_ended, games_won)
+        SELECT DATE(end_time), COUNT(*), SUM(ktyp = 'winning')
+          FROM games WHERE id <= :snapshot AND ''' + NOT_JUNK + '''
+      GROUP BY DATE(end_time)''',
+     '''INSERT INTO date_players''' + SHADOW + '''
+               (which_day, which_month, player, games, wins)
+        SELECT a.which_day, DATE_FORMAT(a.which_day, '%%Y%%m'), f.name,
+               a.games, a.wins
+          FROM (SELECT DATE(end_time) AS which_day, MIN(id) AS first_id,
+                       COUNT(*) AS games, SUM(ktyp = 'winning') AS wins
+                  FROM games WHERE id <= :snapshot AND ''' + NOT_JUNK + '''
+              GROUP BY DATE(end_time), name) a
+          JOIN games f ON f.id = a.first_id''' ],
+   stats.update_per_day_stats),
+
+  (('known_races', 'known_classes'),
+   [ '''INSERT IGNORE INTO known_races''' + SHADOW + ''' (race)
+        SELECT raceabbr FROM games WHERE id <= :snapshot ORDER BY id''',
+     '''INSERT IGNORE INTO known_classes''' + SHADOW + ''' (cls)
+        SELECT clsabbr FROM games WHERE id <= :snapshot ORDER BY id''' ],
+   stats.update_known_races_classes),
+]
+
+def select_groups(tables):
+  """The groups covering tables (all groups if tables is empty)."""
+  if not tables:
+    return GROUPS
+  known = [ t for g in GROUPS for t in g[0] ]
+  for t in tables:
+    if t not in known:
+      raise Exception("Cannot rebuild %s (can rebuild: %s)"
+                      % (t, ", ".join(known)))
+  return [ g for g in GROUPS if [ t for t in g[0] if t in tables ] ]
+
+def check_history(c):
+  """Raises an exception unless games holds as many games as players
+  counts."""
+  games = query_first(c, 'SELECT COUNT(*) FROM games')
+  counted = query_first(c, '''SELECT COALESCE(SUM(games_played), 0)
+                               FROM players''')
+  if int(games) != int(counted):
+    raise Exception("games holds %d games but players counts %d, so a "
+                    "rebuild would lose the rest; load the db from scratch "
+                    "to fill games (or use --force)" % (games, counted))
+
+def last_game(c):
+  return query_first(c, 'SELECT MAX(id) FROM games') or 0
+
+def drop_shadows(c, tables):
+  query_do(c, 'DROP TABLE IF EXISTS '
+           + ",".join([ t + SHADOW for t in tables ]))
+
+def drop_old(c, tables):
+  """Drops the <table>_old copies a failed swap may have left behind,
+  which would make the next swap fail."""
+  query_do(c, 'DROP TABLE IF EXISTS '
+           + ",".join([ t + '_old' for t in tables ]))
+
+def build(c, groups, snapshot):
+  """Fills the shadow copies of the groups' tables from games up to
+  snapshot."""
+  for tables, statements, replay_game in groups:
+    start = time.time()
+    drop_shadows(c, tables)
+    for t in tables:
+      query_do(c, 'CREATE TABLE %s%s LIKE %s' % (t, SHADOW, t))
+    for s in statements:
+      query_do(c, s.replace(':snapshot', str(int(snapshot))))
+    c.execute('COMMIT;')
+    info("Built %s in %.1fs" % (", ".join(tables), time.time() - start))
+
+def swap(c, tables):
+  query_do(c, 'RENAME TABLE ' +
+           ", ".join([ "%s TO %s_old, %s%s TO %s" % (t, t, t, SHADOW, t)
+                       for t in tables ]))
+  query_do(c, 'DROP TABLE ' + ",".join([ t + '_old' for t in tables ]))
+
+def game_dict(row):
+  """A games row as the dictionary stats.act_on_logfile_line is given:
+  under both the xlog and the db names, with times as the logfile parser
+  leaves them."""
+  g = { }
+  for (key, col), value in zip(scload.LOG_DB_MAPPINGS, row):
+    if isinstance(value, datetime.datetime):
+      value = value.strftime('%Y%m%d%H%M%S')
+    g[key] = g[col] = value
+  return g
+
+def replay(c, groups, snapshot, last):
+  """Applies the games after snapshot, up to last, to the swapped-in
+  tables of groups with each group's replay function, in one
+  transaction."""
+  rows = scload.query_rows(c, 'SELECT ' + COLS + ''' FROM games
+                                              WHERE id > %s AND id <= %s
+                                           ORDER BY id''',
+                           snapshot, last)
+  for row in rows:
+    g = game_dict(row)
+    for tables, statements, replay_game in groups:
+      replay_game(c, g)
+  scload.flush_pending(c)
+  return len(rows)
+
+def record_rebuild(c, tables, last):
+  query_do(c, '''INSERT INTO rebuilds (tables, last_game, finished)
+                 VALUES (%s, %s, NOW())''', " ".join(tables), last)
+  c.execute('COMMIT;')
+
+def rebuild(c, tables=None):
+  """Rebuilds tables (by default every derived table) from games."""
+  groups = select_groups(tables)
+  all_tables = [ t for g in groups for t in g[0] ]
+  c.execute('SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED')
+  snapshot = last_game(c)
+  build(c, groups, snapshot)
+  drop_old(c, all_tables)
+  scload.lock_ingest(c)
+  try:
+    swap(c, all_tables)
+    last = last_game(c)
+    c.execute('BEGIN;')
+    try:
+      n = replay(c, groups, snapshot, last)
+    except:
+      c.execute('ROLLBACK;')
+      scload.discard_pending()
+      # scoresd must still reload from the new tables.
+      record_rebuild(c, all_tables, snapshot)
+      error("Games %d to %d were not applied to %s; rebuild them again."
+            % (snapshot + 1, last, ", ".join(all_tables)))
+      raise
+    record_rebuild(c, all_tables, last)
+    info("Rebuilt %s up to game %d (%d games applied after the build)"
+         % (", ".join(all_tables), last, n))
+  finally:
+    scload.unlock_ingest(c)
+
+def main():
+  daemon = "-n" not in sys.argv
+  if daemon:
+    logging.basicConfig(level=logging.INFO, filename=REBUILD_LOGFILE,
+                        format=crawl_utils.LOGFORMAT)
+  else:
+    logging.basicConfig(level=logging.INFO, format=crawl_utils.LOGFORMAT)
+  # Check the table names and the games history before going into the
+  # background.
+  select_groups(scload.ARGS)
+  if not scload.OPT.force:
+    db = scload.connect_db()
+    try:
+      check_history(db.cursor())
+    finally:
+      db.close()
+  if daemon:
+    crawl_utils.daemonize(REBUILD_LOCKFILE)
+  else:
+    crawl_utils.lock_or_die(REBUILD_LOCKFILE)
+
+  db = scload.connect_db()
+  c = db.cursor()
+  try:
+    rebuild(c, scload.ARGS)
+  finally:
+    c.close()
+    db.close()
+
+if __name__ == '__main__':
+  main()
@@ -3,10 +3,13 @@ import re
 import os
 import os.path
 import crawl_utils
+import fetch
+import sidecar
 
 import logging
 from logging import debug, info, warn, error
 
+import memoizer
 from memoizer import Memoizer, DBMemoizer
 
 import ConfigParser
@@ -14,13 +17,39 @@ import imp
 import sys
 import optparse
 import time
+import heapq
+import multiprocessing
+import mmap
 
 oparser = optparse.OptionParser()
 oparser.add_option('-n', '--no-load', action='store_true', dest='no_load')
 oparser.add_option('-o', '--load-only', action='store_true', dest='load_only')
+oparser.add_option('-p', '--parallel-parse', action='store_true',
+                   dest='parallel_parse')
+oparser.add_option('-m', '--mmap', action='store_true', dest='mmap')
+oparser.add_option('-b', '--bulk', action='store_true', dest='bulk')
+oparser.add_option('-c', '--cached', action='store_true', dest='cached')
+oparser.add_option('--force', action='store_true', dest='force')
+oparser.add_option('--stats', action='store_true', dest='stats')
 OPT, ARGS = oparser.parse_args()
 TIME_QUERIES = False
 
+# Parse logfiles in worker processes (one per file with a large enough
+# backlog), leaving the main process free to merge records and write to
+# the db.
+PARALLEL_PARSE = OPT.parallel_parse
+PARALLEL_PARSE_MIN_BYTES = 1024 * 1024
+PARSE_CHUNK_SIZE = 500
+PARSE_QUEUE_CHUNKS = 8
+
+# Read local logfiles through a memory map of the snapshot region instead
+# of a readline() and tell() per record.
+MMAP_LOCAL = OPT.mmap
+
+# Take already-parsed records from logfile sidecars (see sidecar.py) where
+# they are available.
+USE_SIDECARS = OPT.cached
+
 # Limit rows read to so many for testing.
 LIMIT_ROWS = 0
 
@@ -30,7 +59,7 @@ CAO = 'http://crawl.akrasiac.org/'
 CDO = 'http://crawl.develz.org/'
 
 # Log and milestone files. A tuple indicates a remote file with t[1]
-# being the URL to wget -c from. Files can be in any order, loglines
+# being the URL to fetch new data from (see fetch.py). Files can be in any order, loglines
 # will be read in strict chronological order.
 
 # Treat CAO files as remote if running on greensnark's machine
@@ -112,7 +141,16 @@ else:
 BLACKLIST_FILE = 'blacklist.txt'
 EXTENSION_FILE = 'modules.ext'
 SCORING_DB = 'scoring'
+# Commit xlog processing every so many records, or every so many
+# milliseconds, whichever comes first.
 COMMIT_INTERVAL = 3000
+COMMIT_TIME_INTERVAL = 2000
+# Rows per multi-row INSERT when writing in bulk.
+BULK_BATCH_ROWS = 1000
+# MySQL named lock held by each load transaction, and taken by rebuild.py
+# to swap in rebuilt tables between transactions.
+INGEST_LOCK = SCORING_DB + '.ingest'
+INGEST_LOCK_TIMEOUT = 3600
 CRAWLRC_DIRECTORY = '/home/crawl/chroot/dgldir/rcfiles/'
 
 LISTENERS = [ ]
@@ -133,6 +171,18 @@ class CrawlEventListener(object):
   def milestone_event(self, cursor, mdict):
     """Called for each milestone record. cursor will be in a transaction."""
     pass
+  def logfile_batch(self, cursor, records):
+    """Called with a run of logfile records, oldest first, that are
+    chronologically between the milestone batches before and after it.
+    cursor will be in a transaction. Passes each record to logfile_event
+    unless overridden."""
+    for logdict in records:
+      self.logfile_event(cursor, logdict)
+  def milestone_batch(self, cursor, records):
+    """As logfile_batch, for milestone records; passes each record to
+    milestone_event unless overridden."""
+    for mdict in records:
+      self.milestone_event(cursor, mdict)
 
 class CrawlTimerListener:
   def __init__(self, fn=None):
@@ -187,8 +237,75 @@ class Xlogline:
     else:
       return 0
 
-  def process(self, cursor):
-    self.processor(cursor, self.filename, self.offset, self.xdict)
+def parse_xlog_range(filename, start, end, queue):
+  """Worker process body: parses the complete xloglines in filename between
+  byte offsets start and end, putting chunks of (offset, xdict) records on
+  the queue, followed by the offset at which parsing stopped."""
+  try:
+    f = open(filename)
+    try:
+      f.seek(start)
+      offset = start
+      chunk = [ ]
+      while offset < end:
+        line = f.readline()
+        if not line or not line.endswith("\n") or offset + len(line) > end:
+          break
+        offset += len(line)
+        if not line.strip() or invalid_xlog_line(line.strip()):
+          continue
+        chunk.append((offset, xlog_typed_dict(line)))
+        if len(chunk) >= PARSE_CHUNK_SIZE:
+          queue.put(('records', chunk))
+          chunk = [ ]
+      if chunk:
+        queue.put(('records', chunk))
+      queue.put(('done', offset))
+    finally:
+      f.close()
+  except Exception, e:
+    queue.put(('error', "%s: %s" % (filename, e)))
+
+class XlogParseWorker:
+  """Parses a byte range of an xlogfile in a separate process. Parsed
+  records come back in chunks through a bounded queue, so a worker stays at
+  most PARSE_QUEUE_CHUNKS chunks ahead of the reader."""
+  def __init__(self, filename, start, end):
+    self.filename = filename
+    self.queue = multiprocessing.Queue(PARSE_QUEUE_CHUNKS)
+    self.process = multiprocessing.Process(target=parse_xlog_range,
+                                           args=(filename, start, end,
+                                                 self.queue))
+    self.process.daemon = True
+    self.process.start()
+    self.chunk = [ ]
+    self.index = 0
+    self.end_offset = None
+
+  def next(self):
+    """Returns the next (offset, xdict) record, or None once the range is
+    exhausted, at which point end_offset is where parsing stopped."""
+    while self.index >= len(self.chunk):
+      if self.end_offset is not None:
+        return None
+      kind, value = self.queue.get()
+      if kind == 'records':
+        self.chunk = value
+        self.index = 0
+      elif kind == 'done':
+        self.end_offset = value
+        self.close()
+      else:
+        self.close()
+        raise IOError("Parse worker failed on %s" % value)
+    record = self.chunk[self.index]
+    self.index += 1
+    return record
+
+  def close(self):
+    if self.process.is_alive() and self.end_offset is None:
+      self.process.terminate()
+    self.process.join()
 
 class Xlogfile:
   def __init__(self, filename, proc_op, blacklist=None):
@@ -204,6 +321,9 @@ class Xlogfile:
     self.proc_op = proc_op
     self.size  = None
     self.blacklist = blacklist
+    self.worker = None
+    self.map = None
+    self.cached = None
 
   def reinit(self):
     """Reinitialize for a further read from this file."""
@@ -215,14 +335,26 @@ class Xlogfile:
     # remote server.
     if self.local:
       self.size = os.path.getsize(self.filename)
+      if MMAP_LOCAL:
+        self._map()
     else:
       self.fetch_remote()
 
+  def _map(self):
+    """Maps the file up to the current snapshot size."""
+    self._unmap()
+    if self.size and self.have_handle():
+      self.map = mmap.mmap(self.handle.fileno(), self.size,
+                           access=mmap.ACCESS_READ)
+
+  def _unmap(self):
+    if self.map:
+      self.map.close()
+      self.map = None
+
   def fetch_remote(self):
-    info("Fetching remote %s to %s with wget -c" % (self.url, self.filename))
-    res = os.system("wget -q -c %s -O %s" % (self.url, self.filename))
-    if res != 0:
-      raise IOError, "Failed to fetch %s with wget" % self.url
+    debug("Fetching remote %s to %s" % (self.url, self.filename))
+    fetch.fetch_remote(self.url, self.filename)
 
   def _open(self):
     try:
@@ -231,6 +363,16 @@ class Xlogfile:
       warn("Cannot open %s" % self.filename)
       pass
 
+  def reset(self):
+    """Forces a seek to the offset recorded in the db on the next read."""
+    self.offset = None
+    if self.cached:
+      self.cached.close()
+      self.cached = None
+    if self.worker:
+      self.worker.close()
+      self.worker = None
+
   def have_handle(self):
     if self.handle:
       return True
@@ -241,12 +383,30 @@ class Xlogfile:
     if not self.have_handle():
       return
 
-    while True:
-      if not self.offset:
-        xlog_seek(self.filename, self.handle,
-                  dbfile_offset(cursor, self.filename))
-        self.offset = self.handle.tell()
+    if self.offset is None:
+      xlog_seek(self.filename, self.handle,
+                dbfile_offset(cursor, self.filename))
+      self.offset = self.handle.tell()
+      if USE_SIDECARS:
+        self.cached = sidecar.open_reader(self.filename, self.offset,
+                                          self._read_limit())
+      if PARALLEL_PARSE and not self.cached:
+        self._start_worker()
+
+    if self.cached:
+      xline = self._cached_line()
+      if xline:
+        return xline
+
+    if self.worker:
+      xline = self._worker_line()
+      if xline:
+        return xline
+
+    if self.map:
+      return self._mapped_line()
 
+    while True:
       # Don't read beyond the last snapshot size for local files.
       if self.local and self.offset >= self.size:
         return None
@@ -265,13 +425,67 @@ class Xlogfile:
       if not line.strip() or invalid_xlog_line(line.strip()):
         continue
 
-      d = xlog_dict(line)
-      xdict = apply_dbtypes(d)
-      xdict['source_file'] = self.filename
-      xline = Xlogline( self, self.filename, self.offset,
-                        xdict.get('end') or xdict.get('time'),
-                        xdict, self.proc_op )
-      return xline
+      return self._xlogline(self.offset, xlog_typed_dict(line))
+
+  def _mapped_line(self):
+    """line() for memory-mapped local files: finds the next newline in the
+    mapped region, which ends at the snapshot size, so partial lines and
+    anything written after the snapshot are never seen."""
+    m = self.map
+    while True:
+      end = m.find("\n", self.offset)
+      if end == -1:
+        return None
+      line = m[self.offset : end + 1]
+      self.offset = end + 1
+      if not line.strip() or invalid_xlog_line(line):
+        continue
+      return self._xlogline(self.offset, xlog_typed_dict(line))
+
+  def _xlogline(self, offset, xdict):
+    xdict['source_file'] = self.filename
+    return Xlogline( self, self.filename, offset,
+                     xdict.get('end') or xdict.get('time'),
+                     xdict, self.proc_op )
+
+  def _read_limit(self):
+    """The offset not to read past: the snapshot size for local files."""
+    if self.local:
+      return self.size
+    return os.path.getsize(self.filename)
+
+  def _cached_line(self):
+    record = self.cached.next()
+    if record is None:
+      # Parse the rest of the file from where the sidecar ends.
+      self.offset = self.cached.end_offset
+      self.handle.seek(self.offset)
+      self.cached = None
+      if PARALLEL_PARSE:
+        self._start_worker()
+      return None
+    self.offset = record[0]
+    return self._xlogline(record[0], record[1])
+
+  def _start_worker(self):
+    """Hands the unread part of the file (up to the snapshot size for local
+    files) to a parse worker, if there's enough of it to be worth the
+    trouble."""
+    end = self._read_limit()
+    if end - self.offset >= PARALLEL_PARSE_MIN_BYTES:
+      info("Parsing %s (%d bytes) in a worker process"
+           % (self.filename, end - self.offset))
+      self.worker = XlogParseWorker(self.filename, self.offset, end)
+
+  def _worker_line(self):
+    record = self.worker.next()
+    if record is None:
+      # Pick up where the worker left off.
+      self.offset = self.worker.end_offset
+      self.handle.seek(self.offset)
+      self.worker = None
+      return None
+    return self._xlogline(record[0], record[1])
 
 class Logfile (Xlogfile):
   def __init__(self, filename):
@@ -288,34 +502,179 @@ class MasterXlogReader:
   def __init__(self, xlogs):
     self.xlogs = xlogs
 
-  def reinit(self):
+  def reinit(self, xlogs):
+    # Pull all the remote files at once rather than one after another.
+    fetch.fetch_all([ (x.url, x.filename) for x in xlogs if not x.local ])
+    for x in xlogs:
+      if x.local:
+        x.reinit()
+
+  def local_files(self):
+    return [ x.filename for x in self.xlogs if x.local ]
+
+  def select(self, changed=None, remote=True):
+    """Returns the xlogs worth reading: local files named in changed (all
+    local files if changed is None) and, if remote is set, the remote
+    files."""
+    return [ x for x in self.xlogs
+             if (x.local and (changed is None or x.filename in changed))
+             or (not x.local and remote) ]
+
+  def reset(self):
+    """Forget read positions, so that the next read from each file resumes
+    from the last offset committed to the db."""
     for x in self.xlogs:
-      x.reinit()
-
-  def tail_all(self, cursor):
-    self.reinit()
-    lines = [ line for line in [ x.line(cursor) for x in self.xlogs ]
-              if line ]
+      x.reset()
+
+  def tail_all(self, cursor, changed=None, remote=True, batch=None):
+    """Processes all new records, or only those in the local files named in
+    changed (plus the remote files, if remote is set). Files left out have
+    nothing new to merge in, so skipping them doesn't affect ordering.
+    Returns the number of records processed."""
+    xlogs = self.select(changed, remote)
+    if not xlogs:
+      return 0
+    self.reinit(xlogs)
+    merger = XlogMerger(xlogs, cursor)
+    batch = batch or TransactionBatch(cursor)
 
     proc = 0
-    while lines:
-      # Sort dates in descending order.
-      lines.sort()
-      # And pick the oldest.
-      oldest = lines.pop()
-      # Grab a replacement for the one we're going to read from the same file:
-      newline = oldest.owner.line(cursor)
-      if newline:
-        lines.append(newline)
-      # And process the line
-      oldest.process(cursor)
-      proc += 1
-      if LIMIT_ROWS > 0 and proc >= LIMIT_ROWS:
-        break
-      if proc % 3000 == 0:
-        info("Processed %d lines." % proc)
+    try:
+      for line in merger:
+        batch.begin()
+        batch.add(line)
+        proc += 1
+        if LIMIT_ROWS > 0 and proc >= LIMIT_ROWS:
+          break
+        if proc % 3000 == 0:
+          info("Processed %d lines." % proc)
+      batch.commit()
+    except:
+      batch.rollback()
+      self.reset()
+      raise
     if proc > 0:
       info("Done processing %d lines." % proc)
+    return proc
+
+class LockTimeout (Exception):
+  pass
+
+def lock_ingest(cursor):
+  """Takes INGEST_LOCK, waiting for a rebuild.py table swap to finish."""
+  if not query_first(cursor, 'SELECT GET_LOCK(%s, %s)',
+                     INGEST_LOCK, INGEST_LOCK_TIMEOUT):
+    raise LockTimeout("Timed out waiting for lock %s" % INGEST_LOCK)
+
+def unlock_ingest(cursor):
+  query_first(cursor, 'SELECT RELEASE_LOCK(%s)', INGEST_LOCK)
+
+# Id of the last rebuilds row seen; None until checked.
+_last_rebuild = None
+
+def check_rebuilds(cursor):
+  """If rebuild.py has swapped in new tables since the last check, drops
+  the in-memory state that was loaded from the old ones."""
+  global _last_rebuild
+  last = query_first(cursor, 'SELECT MAX(id) FROM rebuilds')
+  if _last_rebuild is not None and last != _last_rebuild:
+    info("Tables were rebuilt, reloading cached state.")
+    discard_derived()
+  _last_rebuild = last
+
+class TransactionBatch:
+  """Groups the db work for many xlog records (listener writes and logfile
+  offsets alike) into one transaction, committing every COMMIT_INTERVAL
+  records or COMMIT_TIME_INTERVAL milliseconds, whichever comes first.
+
+  Records are handed to the listeners in runs of the same kind (logfile or
+  milestone), in the order they were added; a run ends when a record of
+  the other kind comes along or the transaction commits."""
+  def __init__(self, cursor, max_records=None, max_ms=None):
+    self.cursor = cursor
+    self.max_records = max_records or COMMIT_INTERVAL
+    self.max_ms = max_ms or COMMIT_TIME_INTERVAL
+    self.records = 0
+    self.started = None
+    self.run = [ ]
+
+  def begin(self):
+    """Starts a transaction unless one is already open."""
+    if self.started is None:
+      lock_ingest(self.cursor)
+      check_rebuilds(self.cursor)
+      self.cursor.execute('BEGIN;')
+      self.started = time.time()
+      self.records = 0
+
+  def add(self, line):
+    """Adds an Xlogline to the open transaction."""
+    if self.run and self.run[0].processor is not line.processor:
+      self.dispatch()
+    self.run.append(line)
+    self.records += 1
+    if (self.records >= self.max_records
+        or (time.time() - self.started) * 1000 >= self.max_ms):
+      self.commit()
+
+  def dispatch(self):
+    if self.run:
+      run = self.run
+      self.run = [ ]
+      process_batch(self.cursor, run)
+
+  def commit(self):
+    if self.started is None:
+      return
+    self.dispatch()
+    flush_pending(self.cursor)
+    self.cursor.execute('COMMIT;')
+    unlock_ingest(self.cursor)
+    debug("Committed %d records." % self.records)
+    self.started = None
+
+  def rollback(self):
+    if self.started is None:
+      return
+    self.run = [ ]
+    self.cursor.execute('ROLLBACK;')
+    unlock_ingest(self.cursor)
+    discard_pending()
+    warn("Rolled back %d records." % self.records)
+    self.started = None
+
+class XlogMerger:
+  """K-way merge of a list of Xlogfile sources, yielding Xlogline objects
+  oldest first. Each source contributes at most one line to a heap keyed on
+  (time, source index), so picking the oldest line is O(log k) for k sources
+  and lines with identical times come out in source list order."""
+  def __init__(self, xlogs, cursor):
+    self.xlogs = xlogs
+    self.cursor = cursor
+    self.heap = [ ]
+    for index in range(len(xlogs)):
+      self._push(index)
+
+  def _push(self, index):
+    line = self.xlogs[index].line(self.cursor)
+    if line:
+      heapq.heappush(self.heap, (line.time, index, line))
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if not self.heap:
+      raise StopIteration
+    # Grab a replacement for the oldest line from the same file before
+    # handing the oldest line out.
+    index, oldest = self.heap[0][1:]
+    line = self.xlogs[index].line(self.cursor)
+    if line:
+      heapq.heapreplace(self.heap, (line.time, index, line))
+    else:
+      heapq.heappop(self.heap)
+    return oldest
 
 def connect_db():
   connection = MySQLdb.connect(host='localhost',
@@ -406,8 +765,11 @@ def invalid_xlog_line(logline):
   return logline.count(':') < 5
 
 def xlog_dict(logline):
-  d = parse_logline(logline.strip())
+  return xlog_fixup(parse_logline(logline.strip()))
 
+def xlog_fixup(d):
+  """Adds the derived fields (raceabbr, crace, ckiller, milestone verb and
+  noun, etc.) to a parsed xlog dictionary."""
   # Fake a raceabbr field to group on race without failing on
   # draconians.
   if d.get('char'):
@@ -553,6 +915,10 @@ R_PLACE_DEPTH = re.compile(r'^\w+:(\d+)')
 R_GOD_WORSHIP = re.compile(r'^became a worshipper of (.*)\.$')
 R_GOD_MOLLIFY = re.compile(r'^mollified (.*)\.$')
 R_GOD_RENOUNCE = re.compile(r'^abandoned (.*)\.$')
+# The table a write statement changes, for DBMemoizer invalidation.
+R_WRITE_TABLE = re.compile(r'^\s*(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO'
+                           r'|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)'
+                           r'\s+`?(\w+)', re.I)
 
 class SqlType:
   def __init__(self, str_to_sql):
@@ -738,8 +1104,26 @@ def active_cursor():
   global _active_cursor
   return _active_cursor
 
+def written_table(query, keys=None):
+  """Notes a write to the table query changes, so that DBMemoizers reading
+  it recompute; with keys, only the rows with those keys were written (see
+  memoizer.bump_keys)."""
+  m = R_WRITE_TABLE.match(query)
+  if m:
+    if keys is None:
+      memoizer.bump(m.group(1))
+    else:
+      memoizer.bump_keys(m.group(1), keys)
+
 def query_do(cursor, query, *values):
   Query(query, *values).execute(cursor)
+  written_table(query)
+
+def query_do_keyed(cursor, keys, query, *values):
+  """query_do for a write to only the rows of its table with the given
+  keys (see written_table)."""
+  Query(query, *values).execute(cursor)
+  written_table(query, keys)
 
 def query_first(cursor, query, *values):
   return Query(query, *values).first(cursor)
@@ -761,6 +1145,52 @@ def query_first_col(cursor, query, *values):
   rows = query_rows(cursor, query, *values)
   return [x[0] for x in rows]
 
+def query_do_rows(cursor, query, rows, suffix='', batch_size=None,
+                  keys=None):
+  """Writes rows (tuples of values) with multi-row statements of up to
+  batch_size rows: query is the INSERT ... VALUES prefix, followed by a
+  (%s, ...) group per row and then suffix (ON DUPLICATE KEY UPDATE ...).
+  keys, if given, are the keys of the rows written, for written_table."""
+  if not rows:
+    return
+  batch_size = batch_size or BULK_BATCH_ROWS
+  group = "(" + ",".join([ "%s" for x in rows[0] ]) + ")"
+  for i in xrange(0, len(rows), batch_size):
+    chunk = rows[i : i + batch_size]
+    values = [ ]
+    for row in chunk:
+      values.extend(row)
+    Query(query + " " + ",".join([ group for x in chunk ])
+          + " " + suffix, *values).execute(cursor)
+  written_table(query, keys)
+
+def sql_key(s):
+  """Keys compare case-insensitively in MySQL's default collation, so
+  in-memory copies of keyed tables must too."""
+  return s and s.lower()
+
+def sql_max(old, new):
+  """CASE WHEN old < new THEN new ELSE old END, NULLs included."""
+  if old is not None and new is not None and old < new:
+    return new
+  return old
+
+def query_do_many(cursor, query, rows, batch_size=None):
+  """Runs an INSERT ... VALUES (...) query for each of the value tuples in
+  rows, sending batch_size rows per multi-row statement."""
+  batch_size = batch_size or BULK_BATCH_ROWS
+  for i in xrange(0, len(rows), batch_size):
+    chunk = rows[i : i + batch_size]
+    start = time.time()
+    try:
+      cursor.executemany(query, chunk)
+    except:
+      print("Failing query: " + query + " (%d rows)" % len(chunk))
+      raise
+    if TIME_QUERIES:
+      record_query_time(query, time.time() - start)
+  written_table(query)
+
 def game_is_win(g):
   return g['ktyp'] == 'winning'
 
@@ -779,6 +1209,59 @@ def apply_dbtypes(game):
 
   return game
 
+def fast_datetime(x):
+  """datetime() without the regex substitution for the usual
+  YYYYMMDDhhmmss[DS] timestamps."""
+  if len(x) > 6 and x[:6].isdigit():
+    return "%s%02d%s" % (x[:4], 1 + int(x[4:6]), x[6:-1])
+  return datetime(x)
+
+# The same conversions as LOGF_SQLTYPE, but calling builtins directly where
+# possible.
+FAST_SQLTYPES = { sql_int: int, bigint: int, datetime: fast_datetime }
+
+# For each known xlog key: the interned key, the SQL type converter to apply
+# (if any) and the db field name to copy the value to (if it differs).
+XLOG_FIELD_SPECS = dict([ (x,
+                           (intern(x),
+                            FAST_SQLTYPES.get(LOGF_SQLTYPE.get(x)),
+                            x in DB_COPY_FIELDS
+                            and intern(COMBINED_LOG_TO_DB[x])
+                            or None))
+                          for x in COMBINED_LOG_TO_DB.keys() ])
+
+def parse_xlog_typed(logline):
+  """Single-pass equivalent of apply_dbtypes(parse_logline(logline)): splits
+  the line into fields, unescapes colons, applies the SQL type conversions
+  and copies renamed fields to their db names as it goes."""
+  d = { }
+  field_spec = XLOG_FIELD_SPECS.get
+  escaped = '::' in logline
+  if escaped:
+    logline = logline.replace('::', '\n')
+  for item in logline.split(':'):
+    key, eq, value = item.partition('=')
+    if not eq:
+      raise ValueError("Bad xlog field: %s" % item)
+    if escaped and '\n' in value:
+      value = value.replace('\n', ':')
+    spec = field_spec(key)
+    if spec is None:
+      d[intern(key)] = value
+      continue
+    key, sqltype, dbkey = spec
+    if sqltype and value:
+      value = sqltype(value)
+    d[key] = value
+    if dbkey:
+      d[dbkey] = value
+  return d
+
+def xlog_typed_dict(logline):
+  """Parses an xlogline straight into a dictionary ready for the db, as
+  apply_dbtypes(xlog_dict(logline)) would."""
+  return xlog_fixup(parse_xlog_typed(logline.strip()))
+
 def make_xlog_db_query(db_mappings, xdict, filename, offset, table):
   fields = ['source_file']
   values = [filename]
@@ -843,10 +1326,7 @@ def update_highscores(c, xdict, filename, offset):
 def dbfile_offset(cursor, filename):
   """Given a db cursor and filename, returns the offset of the last
   logline from that file that was entered in the db."""
-  return query_first_def(cursor, -1,
-                         '''SELECT offset FROM logfile_offsets
-                            WHERE filename = %s''',
-                         filename)
+  return OFFSETS.offset(cursor, filename)
 
 def update_milestone_bookmark(cursor, filename, offset):
   return update_db_bookmark(cursor, 'milestone_bookmark', filename, offset)
@@ -889,7 +1369,6 @@ def wrap_transaction(fn):
   """Given a function, returns a function that accepts a cursor and arbitrary
   arguments, calls the function with those args, wrapped in a transaction."""
   def transact(cursor, *args):
-    return fn(cursor, *args)
     result = None
     cursor.execute('BEGIN;')
     try:
@@ -897,6 +1376,7 @@ def wrap_transaction(fn):
       cursor.execute('COMMIT;')
     except:
       cursor.execute('ROLLBACK;')
+      memoizer.bump_all()
       raise
     return result
   return transact
@@ -909,46 +1389,97 @@ def create_master_reader():
                 [ Logfile(x) for x in LOGS ])
   return MasterXlogReader(processors)
 
-@DBMemoizer
-def logfile_id(c, filename):
-  return query_first_def(c, None,
-                         '''SELECT id FROM logfile_offsets
-                             WHERE filename = %s''',
-                         filename)
+class OffsetLedger:
+  """In-memory copy of the logfile_offsets table. All offsets are loaded in
+  one query on first use; updates are only recorded in memory and the
+  changed offsets are written out in a single statement at each commit."""
+  def __init__(self):
+    self.offsets = None
+    self.dirty = { }
+
+  def load(self, c):
+    self.offsets = dict(query_rows(c, '''SELECT filename, offset
+                                           FROM logfile_offsets'''))
+    self.dirty.clear()
+
+  def offset(self, c, filename):
+    if self.offsets is None:
+      self.load(c)
+    return self.offsets.get(filename, -1)
+
+  def update(self, filename, offset):
+    self.offsets[filename] = offset
+    self.dirty[filename] = offset
+
+  def flush(self, c):
+    if not self.dirty:
+      return
+    values = [ ]
+    for filename, offset in self.dirty.items():
+      values.append(filename)
+      values.append(offset)
+    query_do(c, 'INSERT INTO logfile_offsets (filename, offset) VALUES ' +
+             ",".join(["(%s, %s)" for x in self.dirty]) +
+             ' ON DUPLICATE KEY UPDATE offset = VALUES(offset)',
+             *values)
+    self.dirty.clear()
+
+  def discard(self):
+    """Drops unwritten updates; offsets are reloaded on next use."""
+    self.offsets = None
+    self.dirty.clear()
+
+OFFSETS = OffsetLedger()
 
 def update_xlog_offset(c, filename, offset):
-  fid = logfile_id(c, filename)
-  if fid:
-    query_do(c, '''UPDATE logfile_offsets SET offset = %s
-                    WHERE id = %s''',
-             offset, fid)
-  else:
-    query_do(c, '''INSERT INTO logfile_offsets (filename, offset)
-                      VALUES (%s, %s)''',
-             filename, offset)
-    logfile_id.flush_key(filename)
-
-def process_xlog(c, filename, offset, d, flambda):
-  """Processes an xlog record for scoring purposes."""
-  if not is_selected(d):
-    return
-  def do_xlogline(cursor):
-    # Tell the listeners to do their thang
-    for listener in LISTENERS:
-      flambda(listener)(cursor, d)
-    # Update the offsets table.
-    update_xlog_offset(c, filename, offset)
-  wrap_transaction(do_xlogline)(c)
-
-def process_log(c, filename, offset, d):
-  """Processes a logfile record for scoring purposes."""
-  return process_xlog(c, filename, offset, d,
-                      lambda l: l.logfile_event)
-
-def process_milestone(c, filename, offset, d):
-  """Processes a milestone record for scoring purposes."""
-  return process_xlog(c, filename, offset, d,
-                      lambda l: l.milestone_event)
+  OFFSETS.update(filename, offset)
+
+# Objects that hold db writes in memory between commits. Each has a
+# flush(c), called just before every commit, and a discard(), called on
+# rollback.
+PENDING_WRITERS = [ ]
+
+def flush_pending(c):
+  """Writes out everything buffered in memory since the last commit. Called
+  just before each commit."""
+  for writer in PENDING_WRITERS:
+    writer.flush(c)
+  OFFSETS.flush(c)
+
+def discard_derived():
+  """Forgets the in-memory copies of the derived tables, along with any
+  writes buffered for them, so that they are loaded again. The logfile
+  offsets are kept: rebuild.py does not touch them, and the readers have
+  already positioned themselves by them."""
+  for writer in PENDING_WRITERS:
+    writer.discard()
+  memoizer.bump_all()
+
+def discard_pending():
+  """Forgets everything buffered in memory since the last commit. Called
+  on rollback."""
+  discard_derived()
+  OFFSETS.discard()
+
+def process_batch(c, lines):
+  """Processes a run of Xloglines of one kind (all logfile or all
+  milestone records), oldest first: each listener gets the selected
+  records as one batch, then the offsets are updated."""
+  records = [ x.xdict for x in lines if is_selected(x.xdict) ]
+  if records:
+    lines[0].processor(c, records)
+  for x in lines:
+    update_xlog_offset(c, x.filename, x.offset)
+
+def process_log(c, records):
+  """Hands a run of logfile records to the listeners."""
+  for listener in LISTENERS:
+    listener.logfile_batch(c, records)
+
+def process_milestone(c, records):
+  """Hands a run of milestone records to the listeners."""
+  for listener in LISTENERS:
+    listener.milestone_batch(c, records)
 
 @Memoizer
 def table_names():
@@ -961,14 +1492,13 @@ def table_names():
       tables.append(m.group(1))
   return tables
 
-@DBMemoizer
+@DBMemoizer.reads('known_classes', 'known_races')
 def is_known_raceclasses_empty(c):
   return (query_first(c, "SELECT COUNT(*) FROM known_classes") == 0
           or query_first(c, "SELECT COUNT(*) FROM known_races") == 0)
 
 def bootstrap_known_raceclasses(c):
   if is_known_raceclasses_empty(c):
-    is_known_raceclasses_empty.flush()
     query_do(c, "TRUNCATE TABLE known_classes")
     query_do(c, "TRUNCATE TABLE known_races")
     query_do(c, """INSERT INTO known_classes
@@ -979,7 +1509,11 @@ def bootstrap_known_raceclasses(c):
 
 def full_load(c, master):
   bootstrap_known_raceclasses(c)
-  master.tail_all(c)
+  if OPT.bulk:
+    import bulkload
+    bulkload.bulk_load(c, master)
+  else:
+    master.tail_all(c)
 
 def init_listeners(db):
   import stats
@@ -1021,4 +1555,5 @@ def scload():
     cursor.close()
 
   report_query_times()
+  memoizer.report()
   db.close()
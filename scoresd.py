@@ -1,9 +1,13 @@
 import MySQLdb
 import scload
 import time
+import os
 import crawl_utils
 import sys
 import query
+import stats
+import watcher
+import memoizer
 
 import logging
 from logging import debug, info, warn, error
@@ -11,9 +15,22 @@ from logging import debug, info, warn, error
 import pagedefs
 
 # Can run as a daemon and tail a number of logfiles and milestones and
-# update the db.
-def interval_work(cursor, interval, master):
-  master.tail_all(cursor)
+# update the db. Local files are read as soon as they change (see
+# watcher.py); remote files are fetched every interval seconds.
+
+# Seconds to wait after a local file changes before reading it, so that a
+# game's logfile and milestone writes are picked up together.
+CHANGE_SETTLE_TIME = 0.5
+# Seconds scoresd.py --stats waits for the daemon to answer; it looks for
+# requests once per pass, so at least one interval.
+STATS_WAIT = 150
+# MySQL errors that mean another connection (rebuild.py, say) held rows we
+# needed for too long: lock wait timeout and deadlock. The pass is rolled
+# back and its files read again on the next one.
+LOCK_WAIT_ERRORS = (1205, 1213)
+
+def interval_work(cursor, master, changed=None, remote=True):
+  return master.tail_all(cursor, changed, remote)
 
 def tail_logfiles(logs, milestones, interval=60):
   db = scload.connect_db()
@@ -21,34 +38,82 @@ def tail_logfiles(logs, milestones, interval=60):
 
   cursor = db.cursor()
   scload.set_active_cursor(cursor)
-  elapsed_time = 0
 
   master = scload.create_master_reader()
   scload.bootstrap_known_raceclasses(cursor)
+  start = time.time()
+  entries = stats.warm_caches(cursor)
+  info("Warmed caches with %d entries in %.2fs."
+       % (entries, time.time() - start))
+  changes = interval and watcher.ChangeWatcher(master.local_files())
+  # The first pass reads everything.
+  changed = None
+  remote = True
+  next_tick = time.time() + interval
   try:
     while True:
       try:
-        interval_work(cursor, interval, master)
-        pagedefs.incremental_build(cursor)
-        if not interval:
-          break
-      except IOError, e:
-        error("IOError: %s" % e)
+        processed = interval_work(cursor, master, changed, remote)
+        if processed or (remote and pagedefs.any_dirty()):
+          pagedefs.incremental_build(cursor)
+      except (IOError, scload.LockTimeout, MySQLdb.OperationalError), e:
+        if (isinstance(e, MySQLdb.OperationalError)
+            and e.args[0] not in LOCK_WAIT_ERRORS):
+          raise
+        error("%s: %s" % (e.__class__.__name__, e))
+        # Retry the files we were asked to read on the next pass (all of
+        # them after a first pass, which has changed None).
+        if changes:
+          if changed is None:
+            changed = master.local_files()
+          changes.pending.update(changed)
 
-      time.sleep(interval)
-      elapsed_time += interval
+      # With no interval there is no watcher: one pass only, even if it
+      # failed.
+      if not changes:
+        break
+      changes.wait(next_tick - time.time())
+      remote = time.time() >= next_tick
+      if remote:
+        next_tick = time.time() + interval
+        pagedefs.tick_dirty()
+      elif changes.pending:
+        time.sleep(CHANGE_SETTLE_TIME)
+      changed = changes.changed()
 
-      pagedefs.tick_dirty()
+      if crawl_utils.scoresd_stats_requested():
+        crawl_utils.write_scoresd_stats(memoizer.report_lines())
 
       if crawl_utils.scoresd_stop_requested():
         info("Exit due to scoresd stop request.")
         break
   finally:
+    if changes:
+      changes.close()
     scload.set_active_cursor(None)
     cursor.close()
     db.close()
 
+def request_stats(wait=STATS_WAIT):
+  """Asks the running daemon for its memoizer stats and prints them;
+  returns False if it does not answer within wait seconds."""
+  crawl_utils.write_scoresd_stats_request()
+  give_up = time.time() + wait
+  while not os.path.exists(crawl_utils.SCORESD_STATS_FILE):
+    if time.time() >= give_up:
+      print "scoresd did not answer within %ds." % wait
+      return False
+    time.sleep(1)
+  # The daemon drops the request once the stats are written out.
+  while crawl_utils.scoresd_stats_requested():
+    time.sleep(0.1)
+  sys.stdout.write(open(crawl_utils.SCORESD_STATS_FILE).read())
+  return True
+
 if __name__ == '__main__':
+  if scload.OPT.stats:
+    sys.exit(not request_stats() and 1 or 0)
+
   daemon = "-n" not in sys.argv
 
   logformat = crawl_utils.LOGFORMAT
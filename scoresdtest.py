@@ -0,0 +1,172 @@
+# Checks scoresd's load loop against a stand-in db cursor, which keeps
+# logfile_offsets in memory and answers the lock and rebuild queries, its
+# logfile watcher across a rotation, and scoresd.py --stats against a
+# stand-in daemon.
+#
+# Usage: python scoresdtest.py
+
+import tempfile
+import shutil
+import subprocess
+import time
+import os
+import os.path
+import sys
+
+import crawl_utils
+import memoizer
+import scload
+import watcher
+
+SAMPLE_LOG = 'sample-log.txt'
+SAMPLE_LINES = 40
+
+class StandInCursor:
+  """Answers the queries a tail pass makes. After commit_rebuild COMMITs,
+  the rebuilds table has a new row, as if rebuild.py had swapped tables in
+  between two transactions."""
+  def __init__(self, commit_rebuild=None):
+    self.offsets = { }
+    self.rebuild_id = 6
+    self.commits = 0
+    self.commit_rebuild = commit_rebuild
+    self.result = [ ]
+
+  def execute(self, query, values=()):
+    q = " ".join(query.split())
+    self.result = [ ]
+    if q.startswith('SELECT GET_LOCK') or q.startswith('SELECT RELEASE_LOCK'):
+      self.result = [ (1,) ]
+    elif q.startswith('SELECT MAX(id) FROM rebuilds'):
+      self.result = [ (self.rebuild_id,) ]
+    elif q.startswith('SELECT filename, offset FROM logfile_offsets'):
+      self.result = self.offsets.items()
+    elif q.startswith('INSERT INTO logfile_offsets'):
+      for i in xrange(0, len(values), 2):
+        self.offsets[values[i]] = values[i + 1]
+    elif q.startswith('COMMIT'):
+      self.commits += 1
+      if self.commits == self.commit_rebuild:
+        self.rebuild_id += 1
+    elif not (q.startswith('BEGIN') or q.startswith('ROLLBACK')):
+      raise Exception("Unexpected query: " + q)
+
+  def fetchone(self):
+    return self.result and self.result[0] or None
+
+  def fetchall(self):
+    return self.result
+
+class RecordingListener (scload.CrawlEventListener):
+  def __init__(self):
+    self.names = [ ]
+
+  def logfile_event(self, cursor, logdict):
+    self.names.append(logdict['name'])
+
+def check(what, cond):
+  print "%-50s %s" % (what, cond and 'ok' or 'FAILED')
+  if not cond:
+    raise AssertionError(what)
+
+def sample_logfile(tmpdir):
+  filename = os.path.join(tmpdir, 'logfile')
+  f = open(filename, 'w')
+  try:
+    f.writelines(open(SAMPLE_LOG).readlines()[:SAMPLE_LINES])
+  finally:
+    f.close()
+  return filename
+
+def check_tail_across_rebuild(tmpdir):
+  filename = sample_logfile(tmpdir)
+  listener = RecordingListener()
+  listeners = scload.LISTENERS[:]
+  scload.LISTENERS[:] = [ listener ]
+  try:
+    c = StandInCursor(commit_rebuild=1)
+    master = scload.MasterXlogReader([ scload.Logfile(filename) ])
+    master.tail_all(c, batch=scload.TransactionBatch(c, 10, 10 ** 9))
+    check("tail pass across a rebuild reads every record",
+          len(listener.names) == SAMPLE_LINES)
+    check("offsets committed after the rebuild",
+          c.offsets.get(filename) == os.path.getsize(filename))
+    check("transactions after the rebuild committed",
+          c.commits == SAMPLE_LINES / 10)
+
+    # A second pass picks up from the committed offset.
+    f = open(filename, 'a')
+    f.write(open(SAMPLE_LOG).readlines()[SAMPLE_LINES])
+    f.close()
+    check("next pass reads only the new record",
+          master.tail_all(c) == 1 and len(listener.names) == SAMPLE_LINES + 1)
+  finally:
+    scload.LISTENERS[:] = listeners
+
+def check_watch_across_rotation(tmpdir):
+  """Rotates a watched logfile (rename it away, write a new one in its
+  place) and checks that writes to the new file are still seen."""
+  filename = os.path.join(tmpdir, 'rotated')
+  open(filename, 'w').close()
+  changes = watcher.ChangeWatcher([ filename ])
+  try:
+    os.rename(filename, filename + '.1')
+    open(filename, 'w').close()
+    changes.wait(1)
+    changes.changed()
+    # The old file is no longer our concern.
+    f = open(filename + '.1', 'a')
+    f.write("old\n")
+    f.close()
+    changes.wait(0.2)
+    check("rotated-away logfile no longer reported",
+          not changes.changed())
+    f = open(filename, 'a')
+    f.write("new\n")
+    f.close()
+    changes.wait(1)
+    check("logfile written after rotation reported",
+          changes.changed() == set([ filename ]))
+  finally:
+    changes.close()
+
+def check_stats_request(tmpdir):
+  """Runs python scoresd.py --stats, answering its request as the daemon
+  would. crawl_utils keeps its files in $HOME when run from a directory
+  under SNARK_USER's, so it runs in one under tmpdir."""
+  rundir = os.path.join(tmpdir, crawl_utils.SNARK_USER)
+  os.mkdir(rundir)
+  env = dict(os.environ)
+  env['HOME'] = tmpdir
+  env['PYTHONPATH'] = os.pathsep.join([ os.getcwd(),
+                                        env.get('PYTHONPATH', '') ])
+  request = os.path.join(tmpdir, 'scoresd.stats-request')
+  answer = os.path.join(tmpdir, 'scoresd.stats')
+  proc = subprocess.Popen([ sys.executable, os.path.abspath('scoresd.py'),
+                            '--stats' ],
+                          cwd=rundir, env=env, stdout=subprocess.PIPE)
+  give_up = time.time() + 60
+  while not os.path.exists(request) and time.time() < give_up:
+    time.sleep(0.1)
+  if not os.path.exists(request):
+    proc.kill()
+  check("scoresd.py --stats sends a request", os.path.exists(request))
+  f = open(answer, 'w')
+  f.write("\n".join(memoizer.report_lines()) + "\n")
+  f.close()
+  os.unlink(request)
+  output = proc.communicate()[0]
+  check("scoresd.py --stats prints the daemon's answer",
+        proc.returncode == 0 and output == open(answer).read())
+
+def main():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    check_tail_across_rebuild(tmpdir)
+    check_watch_across_rotation(tmpdir)
+    check_stats_request(tmpdir)
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,212 @@
+# Parsed-record sidecar files. Historical logfiles never change, yet a full
+# reload parses every line of them again. A sidecar (<logfile>.parsed)
+# holds the already-typed dictionaries for a logfile, so that reads with
+# scload -c take records from the sidecar up to the size it covers and only
+# parse what has been appended to the logfile since.
+#
+# Layout: MAGIC, a header (see HEADER), then chunks of records. Each chunk
+# is a CHUNK_HEADER (end offset of the chunk's last record, byte length)
+# followed by a marshalled list of (end offset, xdict) pairs. The end
+# offset of a record is the logfile offset just past its line, as
+# scload.Xlogline.offset has it.
+#
+# A sidecar is only used if the logfile is at least as long as the part the
+# sidecar covers and the md5 of the first FINGERPRINT_BYTES and of the last
+# FINGERPRINT_BYTES of that part still match.
+#
+# Usage: python sidecar.py [logfile ...]
+# builds or extends the sidecars for the given files (by default, every
+# local logfile and milestone file).
+
+import marshal
+import hashlib
+import os
+import os.path
+import struct
+
+from logging import debug, info, warn, error
+
+SUFFIX = '.parsed'
+MAGIC = 'XLSC1\n'
+# covered logfile size, end of chunk data, head md5, tail md5
+HEADER = struct.Struct('<QQ16s16s')
+CHUNK_HEADER = struct.Struct('<QI')
+FINGERPRINT_BYTES = 64 * 1024
+CHUNK_RECORDS = 1000
+
+def sidecar_name(filename):
+  return filename + SUFFIX
+
+def fingerprint(f, size):
+  """md5 digests of the first and last FINGERPRINT_BYTES of the first size
+  bytes of f."""
+  f.seek(0)
+  head = hashlib.md5(f.read(min(size, FINGERPRINT_BYTES))).digest()
+  tail_start = max(0, size - FINGERPRINT_BYTES)
+  f.seek(tail_start)
+  tail = hashlib.md5(f.read(size - tail_start)).digest()
+  return head, tail
+
+def read_header(filename):
+  """Returns (covered size, data end) if filename has a sidecar that is
+  still valid for it, otherwise None."""
+  name = sidecar_name(filename)
+  if not os.path.exists(name):
+    return None
+  s = open(name, 'rb')
+  try:
+    if s.read(len(MAGIC)) != MAGIC:
+      warn("%s: not a sidecar file, ignoring it" % name)
+      return None
+    covered, data_end, head, tail = HEADER.unpack(s.read(HEADER.size))
+  finally:
+    s.close()
+  if os.path.getsize(filename) < covered:
+    warn("%s has shrunk, ignoring %s" % (filename, name))
+    return None
+  f = open(filename, 'rb')
+  try:
+    if fingerprint(f, covered) != (head, tail):
+      warn("%s does not match %s, ignoring it" % (name, filename))
+      return None
+  finally:
+    f.close()
+  return covered, data_end
+
+class SidecarReader:
+  """Hands out the cached (offset, xdict) records of a logfile whose offsets
+  are past start and no more than limit. When next() returns None,
+  end_offset is where parsing the logfile itself should resume."""
+  def __init__(self, filename, start, limit, header):
+    self.covered, self.data_end = header
+    self.limit = limit
+    self.start = start
+    self.end_offset = start
+    self.handle = open(sidecar_name(filename), 'rb')
+    self.handle.seek(len(MAGIC) + HEADER.size)
+    self.records = [ ]
+    self.index = 0
+    self.done = False
+
+  def _next_chunk(self):
+    while self.handle.tell() < self.data_end:
+      last, nbytes = CHUNK_HEADER.unpack(self.handle.read(CHUNK_HEADER.size))
+      if last <= self.start:
+        self.handle.seek(nbytes, 1)
+        continue
+      return marshal.loads(self.handle.read(nbytes))
+    return None
+
+  def next(self):
+    while not self.done:
+      if self.index >= len(self.records):
+        self.records = self._next_chunk()
+        self.index = 0
+        if self.records is None:
+          self.finish(self.covered <= self.limit and self.covered or None)
+          break
+        continue
+      record = self.records[self.index]
+      self.index += 1
+      offset = record[0]
+      if offset <= self.start:
+        continue
+      if offset > self.limit:
+        self.finish(None)
+        break
+      self.end_offset = offset
+      return record
+    return None
+
+  def finish(self, end_offset):
+    if end_offset is not None and end_offset > self.end_offset:
+      self.end_offset = end_offset
+    self.done = True
+    self.close()
+
+  def close(self):
+    if self.handle:
+      self.handle.close()
+      self.handle = None
+
+def open_reader(filename, start, limit):
+  """Returns a SidecarReader for records past start if filename has a valid
+  sidecar covering any of them, otherwise None."""
+  try:
+    header = read_header(filename)
+  except (IOError, struct.error), e:
+    warn("Cannot read sidecar for %s: %s" % (filename, e))
+    return None
+  if not header or header[0] <= start:
+    return None
+  info("Reading %s records up to offset %d from %s"
+       % (filename, min(header[0], limit), sidecar_name(filename)))
+  return SidecarReader(filename, start, limit, header)
+
+def build(filename, parse, invalid):
+  """Creates the sidecar for filename, or extends a valid one to cover the
+  logfile's current complete lines. parse turns a line into an xdict and
+  invalid(line) is true for lines to skip. Returns the number of records
+  added."""
+  name = sidecar_name(filename)
+  header = read_header(filename)
+  if header:
+    covered, data_end = header
+    s = open(name, 'r+b')
+    s.truncate(data_end)
+  else:
+    covered, data_end = 0, len(MAGIC) + HEADER.size
+    s = open(name, 'wb')
+    s.write(MAGIC + HEADER.pack(0, data_end, '', ''))
+
+  added = 0
+  f = open(filename, 'rb')
+  try:
+    s.seek(data_end)
+    f.seek(covered)
+    offset = covered
+    chunk = [ ]
+    def write_chunk():
+      data = marshal.dumps(chunk)
+      s.write(CHUNK_HEADER.pack(chunk[-1][0], len(data)) + data)
+    while True:
+      line = f.readline()
+      if not line.endswith("\n"):
+        break
+      offset += len(line)
+      if not line.strip() or invalid(line.strip()):
+        continue
+      chunk.append((offset, parse(line)))
+      if len(chunk) >= CHUNK_RECORDS:
+        write_chunk()
+        added += len(chunk)
+        chunk = [ ]
+    if chunk:
+      write_chunk()
+      added += len(chunk)
+    head, tail = fingerprint(f, offset)
+    data_end = s.tell()
+    s.seek(len(MAGIC))
+    s.write(HEADER.pack(offset, data_end, head, tail))
+  finally:
+    f.close()
+    s.close()
+  return added
+
+def main():
+  import logging
+  import crawl_utils
+  import scload
+  logging.basicConfig(level=logging.INFO, format=crawl_utils.LOGFORMAT)
+  files = scload.ARGS or [ isinstance(x, tuple) and x[0] or x
+                           for x in scload.LOGS + scload.MILESTONES ]
+  for filename in files:
+    if not os.path.exists(filename):
+      warn("No such file: %s" % filename)
+      continue
+    added = build(filename, scload.xlog_typed_dict, scload.invalid_xlog_line)
+    info("%s: added %d records to %s" % (filename, added,
+                                         sidecar_name(filename)))
+
+if __name__ == '__main__':
+  main()
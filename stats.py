@@ -3,19 +3,23 @@
 import scload
 import query
 
+import heapq
+import collections
 import logging
 from logging import debug, info, warn, error
 import crawl_utils
 from memoizer import DBMemoizer
 import crawl
 
-from scload import query_do, query_first, query_first_col, wrap_transaction
+from scload import query_do, query_first, query_first_col
 from scload import query_first_def, game_is_win, query_row
-from query import count_players_per_day, winners_for_day
+from scload import query_do_keyed, query_do_rows, sql_key, sql_max
 from pagedefs import dirty_page, dirty_player, dirty_pages
 
 TOP_N = 1000
 MAX_PLAYER_BEST_GAMES = 15
+# Players whose best games are kept in memory.
+PLAYER_CACHE_SIZE = 5000
 MAX_PLAYER_RECENT_GAMES = 15
 MAX_ALL_RECENT_GAMES = 100
 MAX_LOW_XL_RUNE_FINDS = 10
@@ -43,16 +47,160 @@ class OutlineListener (scload.CrawlEventListener):
   def milestone_event(self, cursor, milestone):
     act_on_milestone(cursor, milestone)
 
+  def logfile_batch(self, cursor, records):
+    # One pass over the run; the ghost_victims rows it turns up go out as
+    # one multi-row insert at the end.
+    victims = [ ]
+    for logdict in records:
+      act_on_logfile_line(cursor, logdict, victims)
+    query_do_rows(cursor, '''INSERT INTO ghost_victims (ghost, victim)
+                              VALUES''', victims)
+
+  def milestone_batch(self, cursor, records):
+    # The deepest ziggurat of every player with a ziggurat milestone in the
+    # run is loaded with one query before the pass.
+    load_ziggurat_deepest(cursor, [ m['name'] for m in records
+                                    if m['type'].startswith('zig') ])
+    for milestone in records:
+      act_on_milestone(cursor, milestone)
+
   def cleanup(self, db):
     pass
 
 LISTENER = [ OutlineListener() ]
 
-@DBMemoizer
+class AggregateStats:
+  """The per-game counter updates to players, player_char_stats,
+  top_killers, per_day_stats and date_players, summed in memory per key and
+  written as one multi-row upsert per table when the batch commits."""
+  def __init__(self):
+    self.discard()
+
+  def discard(self):
+    self.players = { }
+    self.char_stats = { }
+    self.killers = { }
+    self.days = { }
+    self.date_players = { }
+
+  def add_player_game(self, g, winc):
+    key = sql_key(g['name'])
+    p = self.players.get(key)
+    if not p:
+      self.players[key] = [ g['name'], 1, winc, g['sc'], g['sc'], g['xl'],
+                            g['start_time'], g['end_time'], g['urune'] ]
+      return
+    p[1] += 1
+    p[2] += winc
+    p[3] += g['sc']
+    p[4] = sql_max(p[4], g['sc'])
+    p[5] = sql_max(p[5], g['xl'])
+    p[7] = g['end_time']
+    p[8] = sql_max(p[8], g['urune'])
+
+  def add_char_game(self, g, winc):
+    key = (sql_key(g['name']), sql_key(g['charabbr']))
+    cs = self.char_stats.get(key)
+    if not cs:
+      self.char_stats[key] = [ g['name'], g['charabbr'], 1, g['xl'], winc ]
+      return
+    cs[2] += 1
+    cs[3] = sql_max(cs[3], g['xl'])
+    cs[4] += winc
+
+  def add_kill(self, ckiller, victim):
+    key = sql_key(ckiller)
+    k = self.killers.get(key)
+    if not k:
+      self.killers[key] = [ ckiller, 1, victim ]
+      return
+    k[1] += 1
+    k[2] = victim
+
+  def add_day_game(self, edate, player, winc):
+    d = self.days.get(edate)
+    if not d:
+      self.days[edate] = [ edate, 1, winc ]
+    else:
+      d[1] += 1
+      d[2] += winc
+    key = (edate, sql_key(player))
+    dp = self.date_players.get(key)
+    if not dp:
+      self.date_players[key] = [ edate, edate[:6], player, 1, winc ]
+    else:
+      dp[3] += 1
+      dp[4] += winc
+
+  def flush(self, c):
+    query_do_rows(c, '''INSERT INTO players
+                               (name, games_played, games_won,
+                                total_score, best_score, best_xl,
+                                first_game_start, last_game_end, max_runes)
+                        VALUES''',
+                  self.players.values(),
+                  '''ON DUPLICATE KEY UPDATE
+                         games_played = games_played + VALUES(games_played),
+                         games_won = games_won + VALUES(games_won),
+                         total_score = total_score + VALUES(total_score),
+                         best_score =
+                               CASE WHEN best_score < VALUES(best_score)
+                                    THEN VALUES(best_score)
+                                    ELSE best_score
+                                    END,
+                         best_xl =
+                               CASE WHEN best_xl < VALUES(best_xl)
+                                    THEN VALUES(best_xl)
+                                    ELSE best_xl
+                                    END,
+                         max_runes = CASE WHEN max_runes < VALUES(max_runes)
+                                          THEN VALUES(max_runes)
+                                          ELSE max_runes END,
+                         last_game_end = VALUES(last_game_end),
+                         current_combo = NULL''',
+                  keys=self.players.keys())
+    query_do_rows(c, '''INSERT INTO player_char_stats
+                               (name, charabbr, games_played, best_xl, wins)
+                        VALUES''',
+                  self.char_stats.values(),
+                  '''ON DUPLICATE KEY UPDATE
+                         games_played = games_played + VALUES(games_played),
+                         best_xl = CASE WHEN best_xl < VALUES(best_xl)
+                                        THEN VALUES(best_xl)
+                                        ELSE best_xl END,
+                         wins = wins + VALUES(wins)''')
+    query_do_rows(c, '''INSERT INTO top_killers
+                               (ckiller, kills, most_recent_victim)
+                        VALUES''',
+                  self.killers.values(),
+                  '''ON DUPLICATE KEY UPDATE
+                         kills = kills + VALUES(kills),
+                         most_recent_victim = VALUES(most_recent_victim)''')
+    query_do_rows(c, '''INSERT INTO per_day_stats
+                               (which_day, games_ended, games_won)
+                        VALUES''',
+                  self.days.values(),
+                  '''ON DUPLICATE KEY UPDATE
+                         games_ended = games_ended + VALUES(games_ended),
+                         games_won = games_won + VALUES(games_won)''')
+    query_do_rows(c, '''INSERT INTO date_players
+                               (which_day, which_month, player, games, wins)
+                        VALUES''',
+                  self.date_players.values(),
+                  '''ON DUPLICATE KEY UPDATE
+                         games = games + VALUES(games),
+                         wins = wins + VALUES(wins)''',
+                  keys=self.days.keys())
+    self.discard()
+
+AGGREGATES = AggregateStats()
+scload.PENDING_WRITERS.append(AGGREGATES)
+
+@DBMemoizer.reads('low_xl_rune_finds')
 def low_xl_rune_count(c):
   return query_first(c, '''SELECT COUNT(*) FROM low_xl_rune_finds''')
 
-@DBMemoizer
+@DBMemoizer.reads('low_xl_rune_finds')
 def worst_xl_rune_find(c):
   row = query_row(c, '''SELECT xl, rune_time FROM low_xl_rune_finds
                         ORDER BY xl DESC, rune_time DESC LIMIT 1''')
@@ -81,26 +229,38 @@ def add_rune_milestone(c, g):
                *worst_rune)
       rinsert()
   else:
-    low_xl_rune_count.flush()
     rinsert()
 
-@DBMemoizer
+@DBMemoizer.reads('ziggurats', by_key=True, capacity=PLAYER_CACHE_SIZE)
 def player_ziggurat_deepest(c, player):
   return query_first_def(c, 0,
                          '''SELECT deepest FROM ziggurats
                               WHERE player = %s''',
                          player)
 
-@DBMemoizer
+def load_ziggurat_deepest(c, names):
+  """Fills player_ziggurat_deepest for those of names it has no result
+  for, with one query per BULK_BATCH_ROWS names."""
+  names = [ n for n in set(names) if not player_ziggurat_deepest.has_key(n) ]
+  if not names:
+    return
+  deepest = dict([ (sql_key(player), d) for player, d in
+                   rows_for_names(c, '''SELECT player, deepest FROM ziggurats
+                                         WHERE player IN (%s)''', names) ])
+  for name in names:
+    player_ziggurat_deepest.set_key(deepest.get(sql_key(name), 0), name)
+
+@DBMemoizer.reads('ziggurats')
 def ziggurat_entry_count(c):
   return query_first(c, '''SELECT COUNT(*) FROM ziggurats''')
 
-@DBMemoizer
+@DBMemoizer.reads('ziggurats')
 def ziggurat_row_inferior_to(c, depth):
-  return query_first_def(c, 0,
-                         '''SELECT id FROM ziggurats
-                             WHERE deepest <= %s
-                          ORDER BY zig_time LIMIT 1''', depth)
+  """The id and player of the oldest ziggurat row no deeper than depth, or
+  None."""
+  return query_row(c, '''SELECT id, player FROM ziggurats
+                          WHERE deepest <= %s
+                       ORDER BY zig_time LIMIT 1''', depth)
 
 def add_ziggurat_milestone(c, g):
   if not g['type'].startswith('zig'):
@@ -120,173 +280,513 @@ def add_ziggurat_milestone(c, g):
   deepest = player_ziggurat_deepest(c, player)
 
   def insert():
-    query_do(c,
-             '''INSERT INTO ziggurats (player, deepest, place, zig_time,
-                                       start_time)
-                               VALUES (%s, %s, %s, %s, %s)''',
-             player, depth, place, g['time'], g['start'])
-    player_ziggurat_deepest.flush_key(player)
+    query_do_keyed(c, [ player ],
+                   '''INSERT INTO ziggurats (player, deepest, place,
+                                             zig_time, start_time)
+                                     VALUES (%s, %s, %s, %s, %s)''',
+                   player, depth, place, g['time'], g['start'])
     dirty_page('overview', 1)
 
   if deepest:
     if depth >= deepest:
-      query_do(c,
-               '''UPDATE ziggurats SET deepest = %s, place = %s,
-                                       zig_time = %s, start_time = %s
-                                 WHERE player = %s''',
-               depth, place, g['time'], g['start'], player)
+      query_do_keyed(c, [ player ],
+                     '''UPDATE ziggurats SET deepest = %s, place = %s,
+                                             zig_time = %s, start_time = %s
+                                       WHERE player = %s''',
+                     depth, place, g['time'], g['start'], player)
       dirty_page('overview', 1)
   else:
     if ziggurat_entry_count(c) >= MAX_ZIGGURAT_VISITS:
       row = ziggurat_row_inferior_to(c, depth)
       if row:
-        query_do(c, '''DELETE FROM ziggurats WHERE id = %s''', row)
-        ziggurat_row_inferior_to.flush_key(depth)
+        query_do_keyed(c, [ row[1] ],
+                       '''DELETE FROM ziggurats WHERE id = %s''', row[0])
         insert()
     else:
-      ziggurat_entry_count.flush()
       insert()
 
 def act_on_milestone(c, g):
   add_rune_milestone(c, g)
   add_ziggurat_milestone(c, g)
 
-@DBMemoizer
-def topN_count(c):
-  return query_first(c, '''SELECT COUNT(*) FROM top_games''')
+class ScoreHeap:
+  """The sc and id of the rows in a bounded best-games set (all of top_games,
+  or one player's player_best_games) in a min-heap, so deciding whether a
+  game gets in needs no queries. Accepted games and the number of existing
+  rows they push out are held as pending writes until the owner flushes
+  them.
+
+  Equal scores are pushed out oldest (lowest id) first, so the rows to
+  delete are always the first ones in ORDER BY sc, id."""
+  def __init__(self, n, rows):
+    self.n = n
+    self.heap = list(rows)
+    heapq.heapify(self.heap)
+    # Stands in for the ids of new rows, which come after all existing ones.
+    self.next_seq = max([ gid for sc, gid in rows ] or [ 0 ]) + 1
+    self.pending = { }
+    self.evicted = 0
+
+  def add(self, g):
+    """Returns True if g made it in."""
+    entry = (g['sc'], self.next_seq)
+    if len(self.heap) >= self.n:
+      if g['sc'] <= self.heap[0][0]:
+        return False
+      sc, seq = heapq.heapreplace(self.heap, entry)
+      if seq in self.pending:
+        del self.pending[seq]
+      else:
+        self.evicted += 1
+    else:
+      heapq.heappush(self.heap, entry)
+    self.pending[self.next_seq] = game_row(g)
+    self.next_seq += 1
+    return True
+
+  def dirty(self):
+    return self.pending or self.evicted
+
+  def take_pending(self):
+    """Returns the pending rows in insertion order and forgets them."""
+    seqs = self.pending.keys()
+    seqs.sort()
+    rows = [ self.pending[s] for s in seqs ]
+    self.pending.clear()
+    self.evicted = 0
+    return rows
+
+class TopGames:
+  """top_games as a ScoreHeap, loaded once and written as one DELETE and one
+  multi-row INSERT when the batch commits."""
+  def __init__(self, n):
+    self.n = n
+    self.discard()
+
+  def discard(self):
+    self.scores = None
+
+  def load(self, c):
+    self.scores = ScoreHeap(self.n, scload.query_rows(c,
+                                        'SELECT sc, id FROM top_games'))
+
+  def add(self, c, g):
+    """Returns True if g made it into the top N."""
+    if self.scores is None:
+      self.load(c)
+    return self.scores.add(g)
+
+  def flush(self, c):
+    if not self.scores or not self.scores.dirty():
+      return
+    if self.scores.evicted:
+      query_do(c, '''DELETE FROM top_games ORDER BY sc, id LIMIT %s''',
+               self.scores.evicted)
+    query_do_rows(c, game_insert_prefix('top_games'),
+                  self.scores.take_pending())
+
+class PlayerBestGames:
+  """player_best_games as a ScoreHeap per player, loaded on first sight of
+  the player. Only the capacity most recently seen players are kept. Writes
+  wait for the batch commit: one DELETE per player who lost rows, then one
+  multi-row INSERT for everyone."""
+  def __init__(self, n, capacity):
+    self.n = n
+    self.capacity = capacity
+    self.discard()
+
+  def discard(self):
+    self.players = collections.OrderedDict()
+    self.dirty = { }
+
+  def warm(self, c, names):
+    """Loads the best games of names, least recently seen first."""
+    scores = collections.OrderedDict([ (sql_key(name), [ ])
+                                       for name in names ])
+    for name, sc, gid in rows_for_names(c, '''SELECT name, sc, id
+                                                FROM player_best_games
+                                               WHERE name IN (%s)''',
+                                        names):
+      scores[sql_key(name)].append((sc, gid))
+    for key, rows in scores.items():
+      if key not in self.players:
+        self.players[key] = ScoreHeap(self.n, rows)
+    while len(self.players) > self.capacity:
+      self.players.popitem(last=False)
+
+  def add(self, c, g):
+    key = sql_key(g['name'])
+    scores = self.players.pop(key, None)
+    if scores is None:
+      scores = ScoreHeap(self.n,
+                         scload.query_rows(c, '''SELECT sc, id
+                                                   FROM player_best_games
+                                                  WHERE name = %s''',
+                                           g['name']))
+    # Most recently seen last.
+    self.players[key] = scores
+    if scores.add(g):
+      self.dirty[key] = g['name']
+      return True
+    return False
+
+  def flush(self, c):
+    rows = [ ]
+    for key, name in self.dirty.items():
+      scores = self.players[key]
+      if scores.evicted:
+        query_do(c, '''DELETE FROM player_best_games WHERE name = %s
+                        ORDER BY sc, id LIMIT %s''',
+                 name, scores.evicted)
+      rows.extend(scores.take_pending())
+    query_do_rows(c, game_insert_prefix('player_best_games'), rows)
+    self.dirty.clear()
+    # Only players with no pending writes can go.
+    while len(self.players) > self.capacity:
+      self.players.popitem(last=False)
+
+class RecentGamesRing:
+  """A recent-games table as a ring of capacity slots per owner (the whole
+  table for all_recent_games, each player for player_recent_games). The
+  owner's seq'th game goes into slot seq % capacity, over the game capacity
+  games before it, so the table never grows past capacity rows per owner
+  and is never trimmed. Writes wait for the batch commit and then go out as
+  one multi-row upsert keyed on the slot; a slot written more than once in
+  a batch is only sent with its last game.
+
+  The next seq of the cache_size most recently seen players is kept in
+  memory; anyone else's is looked up again with MAX(seq)."""
+  def __init__(self, table, capacity, per_player, cache_size=None):
+    self.table = table
+    self.capacity = capacity
+    self.per_player = per_player
+    self.cache_size = cache_size
+    self.insert = ('INSERT INTO %s (%s,slot,seq) VALUES'
+                   % (table, scload.LOG_DB_SCOLUMNS))
+    self.update = ('ON DUPLICATE KEY UPDATE ' +
+                   ",".join([ "%s=VALUES(%s)" % (x, x)
+                              for x in scload.LOG_DB_COLUMNS + ['seq'] ]))
+    self.discard()
+
+  def discard(self):
+    self.next_seq = collections.OrderedDict()
+    self.pending = { }
+
+  def last_seq(self, c, name):
+    if self.per_player:
+      return query_first(c, 'SELECT MAX(seq) FROM %s WHERE name = %%s'
+                         % self.table, name)
+    return query_first(c, 'SELECT MAX(seq) FROM %s' % self.table)
+
+  def warm(self, c, names):
+    """Loads the next seq of names (least recently seen first), or of the
+    whole table if it is not per player."""
+    if not self.per_player:
+      self.next_seq[None] = (self.last_seq(c, None) or 0) + 1
+      return
+    seqs = dict([ (sql_key(name), seq) for name, seq in
+                  rows_for_names(c, '''SELECT name, MAX(seq) FROM %s
+                                       WHERE name IN (%%s)
+                                    GROUP BY name''' % self.table,
+                                 names) ])
+    for name in names:
+      key = sql_key(name)
+      self.next_seq.pop(key, None)
+      self.next_seq[key] = (seqs.get(key) or 0) + 1
+
+  def add(self, c, g):
+    key = self.per_player and sql_key(g['name']) or None
+    seq = self.next_seq.pop(key, None)
+    if seq is None:
+      seq = (self.last_seq(c, g['name']) or 0) + 1
+    # Most recently seen last.
+    self.next_seq[key] = seq + 1
+    slot = seq % self.capacity
+    self.pending[(key, slot)] = game_row(g) + (slot, seq)
+
+  def flush(self, c):
+    query_do_rows(c, self.insert, self.pending.values(), self.update)
+    self.pending.clear()
+    if self.cache_size:
+      while len(self.next_seq) > self.cache_size:
+        self.next_seq.popitem(last=False)
+
+class StreakStates:
+  """What update_player_streak needs to know about each player, kept in
+  memory so that deciding whether a game starts, extends or breaks a streak
+  takes no queries. Only players whose last game was a win have an entry:
+  (the row and end_time of that game, which is the first game of any streak
+  the next win starts, and the id of the active streak or None).
+
+  All entries come from one query the first time they are needed, and are
+  thrown away on rollback to be loaded again."""
+  def __init__(self):
+    self.discard()
+
+  def discard(self):
+    self.players = None
+
+  def load(self, c):
+    self.players = { }
+    for row in scload.query_rows(c,
+                                 "SELECT s.id, " +
+                                 ",".join([ "p." + x
+                                            for x in scload.LOG_DB_COLUMNS ]) +
+                                 ''' FROM player_last_games p
+                                     LEFT JOIN streaks s
+                                       ON s.player = p.name AND s.active = 1
+                                    WHERE p.ktyp = 'winning' '''):
+      g = dict(zip(scload.LOG_DB_COLUMNS, row[1:]))
+      self.players[sql_key(g['name'])] = [ tuple(row[1:]), g['end_time'],
+                                           row[0] ]
+
+  def flush(self, c):
+    pass
 
-@DBMemoizer
-def lowest_highscore(c):
-  return query_first(c, '''SELECT MIN(sc) FROM top_games''')
+  def update(self, c, g, win):
+    """Applies g to the player's streak state and writes the rows that
+    change. Returns 'create', 'extend', 'break' or None."""
+    if self.players is None:
+      self.load(c)
+    player = g['name']
+    key = sql_key(player)
+    state = self.players.pop(key, None)
+    if not win:
+      if state and state[2]:
+        query_do(c, '''UPDATE streaks SET active = 0 WHERE id = %s''',
+                 state[2])
+        g['streak_id'] = state[2]
+        insert_game(c, g, 'streak_breakers', extras = ['streak_id'])
+        return 'break'
+      return None
+
+    row = game_row(g)
+    action = None
+    if state and state[2]:
+      query_do(c, '''UPDATE streaks SET end_game_time = %s,
+                                        ngames = ngames + 1
+                                  WHERE id = %s''',
+               g['end_time'], state[2])
+      GAME_INSERTS.add('streak_games', row)
+      streak_id = state[2]
+      action = 'extend'
+    elif state:
+      query_do(c, '''INSERT INTO streaks
+                                 (player, start_game_time, end_game_time,
+                                  active, ngames)
+                          VALUES (%s, %s, %s, %s, %s)''',
+               player, state[1], g['end_time'], True, 2)
+      streak_id = c.lastrowid
+      # The game that started the streak, and the second game in it.
+      GAME_INSERTS.add('streak_games', state[0])
+      GAME_INSERTS.add('streak_games', row)
+      action = 'create'
+    else:
+      streak_id = None
+    self.players[key] = [ row, g['end_time'], streak_id ]
+    return action
+
+class RecordScores:
+  """The top_combo_scores, top_species_scores and top_class_scores records,
+  as { table: { sql_key(value): sc } }, loaded in one pass the first time
+  they are needed. A game that beats no record costs no queries; new
+  records wait for the batch commit and then go out as one multi-row
+  REPLACE per table (each table is unique on its column), only the best
+  game per value in the batch being sent."""
+  TABLES = (('top_combo_scores', 'charabbr'),
+            ('top_species_scores', 'raceabbr'),
+            ('top_class_scores', 'cls'))
+
+  def __init__(self):
+    self.discard()
+
+  def discard(self):
+    self.scores = None
+    self.pending = dict([ (table, { }) for table, col in self.TABLES ])
+
+  def load(self, c):
+    self.scores = { }
+    for table, col in self.TABLES:
+      self.scores[table] = dict([ (sql_key(value), sc) for value, sc in
+                                  scload.query_rows(c, 'SELECT %s, sc FROM %s'
+                                                    % (col, table)) ])
+
+  def add(self, c, g):
+    """Returns the number of records g set."""
+    if self.scores is None:
+      self.load(c)
+    records = 0
+    for table, col in self.TABLES:
+      key = sql_key(g[col])
+      scores = self.scores[table]
+      if g['sc'] > scores.get(key, 0):
+        scores[key] = g['sc']
+        self.pending[table][key] = game_row(g)
+        records += 1
+    return records
+
+  def flush(self, c):
+    for table, col in self.TABLES:
+      rows = self.pending[table]
+      query_do_rows(c, game_insert_prefix(table, verb='REPLACE'),
+                    rows.values())
+      rows.clear()
+
+class GameInserts:
+  """The rows insert_game writes, held per statement (table and extra
+  columns) until the batch commits and then written in the order they came
+  in, one multi-row INSERT per statement."""
+  def __init__(self):
+    self.discard()
+
+  def discard(self):
+    self.pending = collections.OrderedDict()
+
+  def add(self, table, row, extras=()):
+    statement = game_insert_prefix(table, extras)
+    rows = self.pending.get(statement)
+    if rows is None:
+      rows = self.pending[statement] = [ ]
+    rows.append(row)
+
+  def flush(self, c):
+    for statement, rows in self.pending.items():
+      query_do_rows(c, statement, rows)
+    self.pending.clear()
+
+class LatestGames:
+  """A table that keeps only the latest game per value of col, and is
+  unique on col (killer_recent_kills, player_last_games). The games of a
+  batch are held by value, last one winning, and sent as one multi-row
+  REPLACE when the batch commits."""
+  def __init__(self, table, col):
+    self.table = table
+    self.col = col
+    self.discard()
+
+  def discard(self):
+    self.pending = { }
+
+  def add(self, g):
+    self.pending[sql_key(g[self.col])] = game_row(g)
+
+  def flush(self, c):
+    query_do_rows(c, game_insert_prefix(self.table, verb='REPLACE'),
+                  self.pending.values())
+    self.pending.clear()
+
+class FirstGames:
+  """player_first_games: the first game of each player not already in the
+  table is held until the batch commits, then all of them are sent as one
+  multi-row INSERT."""
+  def __init__(self):
+    self.pending = collections.OrderedDict()
+
+  def discard(self):
+    self.pending.clear()
+    player_first_game_exists.flush()
+
+  def add(self, c, g):
+    player = g['name']
+    key = sql_key(player)
+    if key in self.pending or player_first_game_exists(c, player):
+      return
+    self.pending[key] = (player, game_row(g))
+
+  def flush(self, c):
+    query_do_rows(c, game_insert_prefix('player_first_games',
+                                        verb='INSERT IGNORE'),
+                  [ row for player, row in self.pending.values() ])
+    # Only now are they in the table.
+    for player, row in self.pending.values():
+      player_first_game_exists.set_key(True, player)
+    self.pending.clear()
+
+TOP_GAMES = TopGames(TOP_N)
+scload.PENDING_WRITERS.append(TOP_GAMES)
+
+PLAYER_BEST_GAMES = PlayerBestGames(MAX_PLAYER_BEST_GAMES, PLAYER_CACHE_SIZE)
+scload.PENDING_WRITERS.append(PLAYER_BEST_GAMES)
+
+ALL_RECENT_GAMES = RecentGamesRing('all_recent_games', MAX_ALL_RECENT_GAMES,
+                                   False)
+scload.PENDING_WRITERS.append(ALL_RECENT_GAMES)
+
+PLAYER_RECENT_GAMES = RecentGamesRing('player_recent_games',
+                                      MAX_PLAYER_RECENT_GAMES, True,
+                                      PLAYER_CACHE_SIZE)
+scload.PENDING_WRITERS.append(PLAYER_RECENT_GAMES)
+
+STREAKS = StreakStates()
+scload.PENDING_WRITERS.append(STREAKS)
+
+RECORD_SCORES = RecordScores()
+scload.PENDING_WRITERS.append(RECORD_SCORES)
+
+KILLER_RECENT_KILLS = LatestGames('killer_recent_kills', 'ckiller')
+scload.PENDING_WRITERS.append(KILLER_RECENT_KILLS)
+
+PLAYER_LAST_GAMES = LatestGames('player_last_games', 'name')
+scload.PENDING_WRITERS.append(PLAYER_LAST_GAMES)
+
+PLAYER_FIRST_GAMES = FirstGames()
+scload.PENDING_WRITERS.append(PLAYER_FIRST_GAMES)
+
+GAME_INSERTS = GameInserts()
+scload.PENDING_WRITERS.append(GAME_INSERTS)
+
+def rows_for_names(c, query, names):
+  """The rows of query, whose IN (%s) is filled with names, asking for
+  BULK_BATCH_ROWS names at a time."""
+  rows = [ ]
+  for i in xrange(0, len(names), scload.BULK_BATCH_ROWS):
+    chunk = names[i : i + scload.BULK_BATCH_ROWS]
+    rows.extend(scload.query_rows(c, query % ",".join([ "%s" for x in chunk ]),
+                                  *chunk))
+  return rows
+
+def game_row(g):
+  """The values for an insert_game row, in LOG_DB_MAPPINGS order."""
+  return tuple([ g.get(x[0]) for x in scload.LOG_DB_MAPPINGS ])
+
+# INSERT ... VALUES prefixes for game rows, by (verb, table, extras).
+GAME_STATEMENTS = { }
+
+def game_insert_prefix(table, extras=(), verb='INSERT'):
+  """The '<verb> INTO table (columns) VALUES' prefix for game rows followed
+  by the extras columns, built once per table and extras."""
+  key = (verb, table, tuple(extras))
+  statement = GAME_STATEMENTS.get(key)
+  if statement is None:
+    statement = GAME_STATEMENTS[key] = (
+      '%s INTO %s (%s) VALUES'
+      % (verb, table, ",".join(scload.LOG_DB_COLUMNS + list(extras))))
+  return statement
 
 def insert_game(c, g, table, extras = []):
-  cols = scload.LOG_DB_MAPPINGS
-  colnames = scload.LOG_DB_SCOLUMNS
-  places = scload.LOG_DB_SPLACEHOLDERS
-  if extras:
-    cols = list(cols)
-    for item in extras:
-      cols.append([item, item])
-    colnames = ",".join([x[1] for x in cols])
-    places = ",".join(["%s" for x in cols])
-  query_do(c,
-           'INSERT INTO %s (%s) VALUES (%s)' %
-           (table, colnames, places),
-           *[g.get(x[0]) for x in cols])
-
-def update_topN(c, g, n):
-  if topN_count(c) >= n:
-    if g['sc'] > lowest_highscore(c):
-      query_do(c,'''DELETE FROM top_games
-                          WHERE id = %s''',
-               query_first(c, '''SELECT id FROM top_games
-                                  ORDER BY sc LIMIT 1'''))
-      insert_game(c, g, 'top_games')
-      lowest_highscore.flush()
-      dirty_pages('top-N', 'overview')
-  else:
-    insert_game(c, g, 'top_games')
-    dirty_pages('top-N', 'overview')
-    topN_count.flush()
-
-@DBMemoizer
-def player_best_game_count(c, player):
-  return query_first(c, '''SELECT COUNT(*) FROM player_best_games
-                                          WHERE name = %s''',
-                     player)
+  """Adds g (and the values of its extras keys) to table when the batch
+  commits."""
+  GAME_INSERTS.add(table, game_row(g) + tuple([ g.get(x) for x in extras ]),
+                   extras)
 
-@DBMemoizer
-def player_lowest_highscore(c, player):
-  return query_first(c, '''SELECT MIN(sc) FROM player_best_games
-                                         WHERE name = %s''',
-                     player)
+def update_topN(c, g):
+  if TOP_GAMES.add(c, g):
+    dirty_pages('top-N', 'overview')
 
-@DBMemoizer
+# Kept up to date by PLAYER_FIRST_GAMES rather than by table generation:
+# player_first_games is written on nearly every commit.
+@DBMemoizer.sized(PLAYER_CACHE_SIZE)
 def player_first_game_exists(c, player):
   return query_first_def(c, False,
                          '''SELECT id FROM player_first_games
                                 WHERE name = %s''', player)
 
-@DBMemoizer
-def player_recent_game_count(c, player):
-  return query_first(c, '''SELECT COUNT(*) FROM player_recent_games
-                                          WHERE name = %s''',
-                     player)
-
-@DBMemoizer
-def all_recent_game_count(c):
-  return query_first(c, '''SELECT COUNT(*) FROM all_recent_games''')
-
-@DBMemoizer
-def player_streak_is_active(c, player):
-  return query_first_def(c, False,
-                         '''SELECT active FROM streaks
-                                          WHERE player = %s AND active = 1''',
-                         player)
-
-def player_won_last_game(c, player):
-  return query_first_def(c, False,
-                         '''SELECT id FROM player_last_games
-                                     WHERE name = %s
-                                       AND ktyp='winning' ''',
-                         player)
-
-def player_last_game_end_time(c, player):
-  return query_first(c, '''SELECT end_time FROM player_last_games
-                                          WHERE name = %s''',
-                     player)
-
-def player_create_streak(c, player, g):
-  query_do(c, '''INSERT INTO streaks
-                             (player, start_game_time, end_game_time,
-                              active, ngames)
-                      VALUES (%s, %s, %s, %s, %s)''',
-           player, player_last_game_end_time(c, player), g['end_time'],
-           True, 2)
-
-  # Record the game that started the streak:
-  query_do(c,
-           "INSERT INTO streak_games (" + scload.LOG_DB_SCOLUMNS + ") " +
-           "SELECT " + scload.LOG_DB_SCOLUMNS +
-           ''' FROM player_last_games WHERE name = %s''', player)
-
-  # And the second game in the streak:
-  insert_game(c, g, 'streak_games')
-
-def player_active_streak_id(c, player):
-  return query_first(c, '''SELECT id FROM streaks
-                                    WHERE player = %s AND active = 1''',
-                     player)
-
-def player_break_streak(c, player, g):
-  aid = player_active_streak_id(c, player)
-  query_do(c, '''UPDATE streaks SET active = 0 WHERE id = %s''', aid)
-  g['streak_id'] = aid
-  insert_game(c, g, 'streak_breakers', extras = ['streak_id'])
-
-def player_extend_streak(c, player, g):
-  query_do(c, '''UPDATE streaks SET end_game_time = %s, ngames = ngames + 1
-                              WHERE player = %s AND active = 1''',
-           g['end_time'], player)
-  insert_game(c, g, 'streak_games')
-
 def update_player_streak(c, g):
-  player = g['name']
-  win = game_is_win(g)
-  if not win:
-    if player_streak_is_active(c, player):
-      player_break_streak(c, player, g)
-      player_streak_is_active.flush_key(player)
-      dirty_pages('streaks', 'overview')
-      dirty_player(player)
-  else:
-    if player_streak_is_active(c, player):
-      player_extend_streak(c, player, g)
-      dirty_pages('streaks', 'overview')
-    elif player_won_last_game(c, player):
-      player_create_streak(c, player, g)
-      dirty_pages('streaks', 'overview')
-      player_streak_is_active.flush_key(player)
+  action = STREAKS.update(c, g, game_is_win(g))
+  if action:
+    dirty_pages('streaks', 'overview')
+  if action == 'break':
+    dirty_player(g['name'])
 
 def update_all_recent_games(c, g):
   if is_junk_game(g):
@@ -294,71 +794,22 @@ def update_all_recent_games(c, g):
 
   dirty_page('recent', 1)
   dirty_page('per-day', 1)
-  insert_game(c, g, 'all_recent_games')
-  if all_recent_game_count.has_key():
-    all_recent_game_count.set_key(all_recent_game_count(c) + 1)
-
-  if all_recent_game_count(c) > MAX_ALL_RECENT_GAMES + 50:
-    extra = all_recent_game_count(c) - MAX_ALL_RECENT_GAMES
-    ids = query_first_col(c, '''SELECT id FROM all_recent_games
-                                 ORDER BY id LIMIT %s''',
-                          extra)
-    query_do(c, '''DELETE FROM all_recent_games WHERE id IN (%s)''',
-             ",".join([str(x) for x in ids]))
-    all_recent_game_count.flush_key()
+  ALL_RECENT_GAMES.add(c, g)
 
 def update_player_recent_games(c, g):
-  player = g['name']
-  insert_game(c, g, 'player_recent_games')
-  if player_recent_game_count.has_key(player):
-    player_recent_game_count.set_key(player_recent_game_count(c, player) + 1,
-                                     player)
-  if player_recent_game_count(c, player) > MAX_PLAYER_RECENT_GAMES + 50:
-    extra = player_recent_game_count(c, player) - MAX_PLAYER_RECENT_GAMES
-    ids = query_first_col(c, '''SELECT id FROM player_recent_games
-                                 WHERE name = %s ORDER BY id LIMIT %s''',
-                          player, extra)
-    query_do(c, '''DELETE FROM player_recent_games WHERE id IN (%s)''',
-             ",".join([str(x) for x in ids]))
-    player_recent_game_count.flush_key(player)
+  PLAYER_RECENT_GAMES.add(c, g)
 
 def update_player_best_games(c, g):
-  player = g['name']
-  if player_best_game_count(c, player) >= MAX_PLAYER_BEST_GAMES:
-    if g['sc'] > player_lowest_highscore(c, player):
-      query_do(c, '''DELETE FROM player_best_games WHERE id = %s''',
-               query_first(c, '''SELECT id FROM player_best_games
-                                       WHERE name = %s
-                                    ORDER BY sc LIMIT 1''',
-                           player))
-      insert_game(c, g, 'player_best_games')
-      player_lowest_highscore.flush_key(player)
-  else:
-    insert_game(c, g, 'player_best_games')
-    player_best_game_count.flush_key(player)
+  PLAYER_BEST_GAMES.add(c, g)
 
 def update_player_char_stats(c, g):
-  winc = game_is_win(g) and 1 or 0
-  query_do(c, '''INSERT INTO player_char_stats
-                             (name, charabbr, games_played, best_xl, wins)
-                      VALUES (%s, %s, %s, %s, %s)
-                 ON DUPLICATE KEY UPDATE games_played = games_played + 1,
-                                         best_xl = CASE WHEN best_xl < %s
-                                                        THEN %s
-                                                        ELSE best_xl END,
-                                         wins = wins + %s''',
-           g['name'], g['charabbr'], 1, g['xl'], winc,
-           g['xl'], g['xl'], winc)
+  AGGREGATES.add_char_game(g, game_is_win(g) and 1 or 0)
 
 def update_player_first_game(c, g):
-  player = g['name']
-  if not player_first_game_exists(c, player):
-    player_first_game_exists.flush_key(player)
-    insert_game(c, g, 'player_first_games')
+  PLAYER_FIRST_GAMES.add(c, g)
 
 def update_player_last_game(c, g):
-  query_do(c, '''DELETE FROM player_last_games WHERE name = %s''', g['name'])
-  insert_game(c, g, 'player_last_games')
+  PLAYER_LAST_GAMES.add(g)
 
 def update_wins_table(c, g):
   if game_is_win(g):
@@ -382,33 +833,7 @@ def update_player_stats(c, g):
     else:
       dirty_player(g['name'], 1)
 
-  query_do(c, '''INSERT INTO players
-                             (name, games_played, games_won,
-                              total_score, best_score, best_xl,
-                              first_game_start, last_game_end, max_runes)
-                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                 ON DUPLICATE KEY UPDATE
-                             games_played = games_played + 1,
-                             games_won = games_won + %s,
-                             total_score = total_score + %s,
-                             best_score =
-                                   CASE WHEN best_score < %s
-                                        THEN %s
-                                        ELSE best_score
-                                        END,
-                             best_xl =
-                                   CASE WHEN best_xl < %s
-                                        THEN %s
-                                        ELSE best_xl
-                                        END,
-                             max_runes = CASE WHEN max_runes < %s
-                                              THEN %s ELSE max_runes END,
-                             last_game_end = %s,
-                             current_combo = NULL''',
-           g['name'], 1, winc, g['sc'], g['sc'], g['xl'], g['start_time'],
-           g['end_time'], g['urune'],
-           winc, g['sc'], g['sc'], g['sc'], g['xl'], g['xl'],
-           g['urune'], g['urune'], g['end_time'])
+  AGGREGATES.add_player_game(g, winc)
 
   # Must be first!
   update_player_streak(c, g)
@@ -421,71 +846,30 @@ def update_player_stats(c, g):
   update_player_last_game(c, g)
   update_wins_table(c, g)
 
-def top_score_for_cthing(c, col, table, thing):
-  q = "SELECT sc FROM %s WHERE %s = %s" % (table, col, '%s')
-  return query_first_def(c, 0, q, thing)
-
-@DBMemoizer
-def top_score_for_combo(c, ch):
-  return top_score_for_cthing(c, 'charabbr', 'top_combo_scores', ch)
-
-@DBMemoizer
-def top_score_for_species(c, sp):
-  return top_score_for_cthing(c, 'raceabbr', 'top_species_scores', sp)
-
-@DBMemoizer
-def top_score_for_class(c, cls):
-  return top_score_for_cthing(c, 'cls', 'top_class_scores', cls)
-
-def update_topscore_table_for(c, g, fn, table, thing):
-  sc = g['sc']
-  value = g[thing]
-  if sc > fn(c, value):
-    fn.flush_key(value)
-    query_do(c, "DELETE FROM " + table + " WHERE " + thing + " = %s", value)
-    insert_game(c, g, table)
+def update_combo_scores(c, g):
+  for i in xrange(RECORD_SCORES.add(c, g)):
     dirty_page('top-combo-scores', 25)
     dirty_page('combo-scoreboard', 25)
     dirty_page('overview', 5)
 
-def update_combo_scores(c, g):
-  update_topscore_table_for(c, g, top_score_for_combo,
-                            'top_combo_scores', 'charabbr')
-  update_topscore_table_for(c, g, top_score_for_species,
-                            'top_species_scores', 'raceabbr')
-  update_topscore_table_for(c, g, top_score_for_class,
-                            'top_class_scores', 'cls')
-
-@DBMemoizer
-def ckiller_record_exists(c, ckiller):
-  return query_first_def(c, False,
-                         '''SELECT id FROM killer_recent_kills
-                                     WHERE ckiller = %s''',
-                         ckiller)
-
 def update_killer_stats(c, g):
   ckiller = g['ckiller']
   if ckiller != 'winning':
     dirty_page('killers', 1)
 
-  query_do(c, '''INSERT INTO top_killers
-                             (ckiller, kills, most_recent_victim)
-                      VALUES (%s, %s, %s)
-                 ON DUPLICATE KEY UPDATE kills = kills + 1,
-                                         most_recent_victim = %s''',
-           ckiller, 1, g['name'], g['name'])
-  if ckiller_record_exists(c, ckiller):
-    query_do(c, '''DELETE FROM killer_recent_kills WHERE ckiller = %s''',
-             ckiller)
-  else:
-    ckiller_record_exists.set_key(True, ckiller)
-  insert_game(c, g, 'killer_recent_kills')
+  AGGREGATES.add_kill(ckiller, g['name'])
+  KILLER_RECENT_KILLS.add(g)
 
-def update_gkills(c, g):
+def update_gkills(c, g, victims=None):
+  """Records the ghost's victim, in victims if given (for the caller to
+  write), or right away."""
   if scload.is_ghost_kill(g):
     dirty_page('gkills', 1)
     ghost = scload.extract_ghost_name(g['killer'])
     if ghost != g['name']:
+      if victims is not None:
+        victims.append((ghost, g['name']))
+        return
       query_do(c,
                '''INSERT INTO ghost_victims (ghost, victim) VALUES (%s, %s)''',
                ghost, g['name'])
@@ -508,27 +892,7 @@ def update_per_day_stats(c, g):
   # Grab just the date portion.
   edate = g['end_time'][:8]
   winc = game_is_win(g) and 1 or 0
-
-  count_players_per_day.flush_key(edate)
-  if winc:
-    winners_for_day.flush_key(edate)
-
-  query_do(c, '''INSERT INTO per_day_stats (which_day, games_ended,
-                                            games_won)
-                                    VALUES (%s, %s, %s)
-                        ON DUPLICATE KEY UPDATE
-                                     games_ended = games_ended + 1,
-                                     games_won = games_won + %s''',
-           edate, 1, winc, winc)
-
-  player = g['name']
-  query_do(c, '''INSERT INTO date_players (which_day, which_month, player,
-                                           games, wins)
-                                   VALUES (%s, %s, %s, %s, %s)
-                        ON DUPLICATE KEY UPDATE
-                                        games = games + 1,
-                                        wins = wins + %s''',
-           edate, edate[:6], player, 1, winc, winc)
+  AGGREGATES.add_day_game(edate, g['name'], winc)
 
 def is_known_cthing(c, table, key, value):
   return query_first_def(c, False,
@@ -536,47 +900,93 @@ def is_known_cthing(c, table, key, value):
                          " WHERE " + key + " = %s",
                          value)
 
-@DBMemoizer
+@DBMemoizer.reads('known_races', by_key=True)
 def is_known_race(c, race):
   return is_known_cthing(c, 'known_races', 'race', race)
 
-@DBMemoizer
+@DBMemoizer.reads('known_classes', by_key=True)
 def is_known_class(c, cls):
   return is_known_cthing(c, 'known_classes', 'cls', cls)
 
 def record_known_thing(c, table, key, value):
-  query_do(c, "INSERT INTO " + table + " (" + key + ") " +
-           " VALUES (%s)", value)
+  query_do_keyed(c, [ value ], "INSERT INTO " + table + " (" + key + ") " +
+                 " VALUES (%s)", value)
 
 def update_known_races_classes(c, g):
   race = g['raceabbr']
   cls = g['clsabbr']
   if not is_known_race(c, race):
     record_known_thing(c, 'known_races', 'race', race)
-    is_known_race.set_key(True, race)
-    query.all_races.flush()
   if not is_known_class(c, cls):
     record_known_thing(c, 'known_classes', 'cls', cls)
-    is_known_class.set_key(True, cls)
-    query.all_classes.flush()
 
-def act_on_logfile_line(c, this_game):
+def warm_caches(c):
+  """Fills the in-memory state and memos that processing games needs from a
+  few bulk queries, so that a freshly started daemon does not pay for them
+  a miss at a time. The PLAYER_CACHE_SIZE most recently active players are
+  loaded. Returns the number of entries loaded."""
+  scload.lock_ingest(c)
+  try:
+    # Notes the last rebuild, so that one after this is noticed.
+    scload.check_rebuilds(c)
+    names = scload.query_first_col(c, '''SELECT name FROM players
+                                      ORDER BY last_game_end DESC
+                                      LIMIT %s''', PLAYER_CACHE_SIZE)
+    names.reverse()
+
+    TOP_GAMES.load(c)
+    STREAKS.load(c)
+    RECORD_SCORES.load(c)
+    PLAYER_BEST_GAMES.warm(c, names)
+    ALL_RECENT_GAMES.warm(c, names)
+    PLAYER_RECENT_GAMES.warm(c, names)
+    entries = (len(TOP_GAMES.scores.heap) + len(STREAKS.players)
+               + sum([ len(x) for x in RECORD_SCORES.scores.values() ])
+               + len(PLAYER_BEST_GAMES.players)
+               + len(ALL_RECENT_GAMES.next_seq)
+               + len(PLAYER_RECENT_GAMES.next_seq))
+
+    # Every player has a first game.
+    for name in names:
+      player_first_game_exists.set_key(True, name)
+    # Kept until that player's next ziggurat milestone, as the memo is
+    # invalidated by player.
+    load_ziggurat_deepest(c, names)
+    for race in query.all_races(c):
+      is_known_race.set_key(True, race)
+    for cls in query.all_classes(c):
+      is_known_class.set_key(True, cls)
+    ziggurat_entry_count(c)
+    low_xl_rune_count(c)
+    for memo in (player_first_game_exists, player_ziggurat_deepest,
+                 is_known_race, is_known_class, query.all_races,
+                 query.all_classes, ziggurat_entry_count, low_xl_rune_count):
+      entries += len(memo.cache)
+    return entries
+  finally:
+    scload.unlock_ingest(c)
+
+def act_on_logfile_line(c, this_game, victims=None):
   """Actually assign things and write to the db based on a logfile line
   coming through. All lines get written to the db; some will assign
   irrevocable points and those should be assigned immediately. Revocable
   points (high scores, lowest dungeon level, fastest wins) should be
-  calculated elsewhere."""
+  calculated elsewhere. Ghost victims go into victims if given (see
+  update_gkills)."""
 
   if 'start_time' not in this_game:
     return
 
+  # The game history the derived tables can be rebuilt from.
+  insert_game(c, this_game, 'games')
+
   # Update top-1000.
-  update_topN(c, this_game, TOP_N)
+  update_topN(c, this_game)
 
   # Update statistics for this player's game.
   update_player_stats(c, this_game)
   update_combo_scores(c, this_game)
   update_killer_stats(c, this_game)
-  update_gkills(c, this_game)
+  update_gkills(c, this_game, victims)
   update_per_day_stats(c, this_game)
   update_known_races_classes(c, this_game)
@@ -3,7 +3,7 @@
    c = attributes['cursor']
 
    recent_wins = query.find_games(c, 'wins', sort_max='id', limit=15)
-   recent_games = query.find_games(c, 'all_recent_games', sort_max='id',
+   recent_games = query.find_games(c, 'all_recent_games', sort_max='seq',
                                      limit=60)
 %>
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
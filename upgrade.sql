@@ -0,0 +1,58 @@
+-- Brings a db created from an older database.sql up to date, keeping its
+-- data. Run it once, with scoresd.py stopped:
+--   mysql -uscoring scoring < upgrade.sql
+--
+-- games starts out empty here and only collects the games loaded from now
+-- on: there is nothing to backfill it from, so rebuild.py refuses to run
+-- until the db has been loaded from scratch (or is told to with --force).
+
+CREATE TABLE games AS SELECT * FROM player_best_games LIMIT 0;
+ALTER TABLE games ADD CONSTRAINT PRIMARY KEY (id);
+ALTER TABLE games CHANGE COLUMN id id BIGINT AUTO_INCREMENT;
+CREATE INDEX games_name_id ON games (name, id);
+
+CREATE TABLE rebuilds (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  tables VARCHAR(1000),
+  last_game BIGINT,
+  finished DATETIME
+);
+
+-- The recent-games tables become ring buffers (see stats.py for the
+-- capacities, 100 games in all and 15 per player). The old code only
+-- trimmed a table once it went 50 games over, so first everything but the
+-- newest capacity games goes; the rest are numbered in id order, and go
+-- into slot seq mod capacity.
+DELETE r FROM all_recent_games r
+  JOIN (SELECT a.id
+          FROM all_recent_games a JOIN all_recent_games b ON b.id > a.id
+         GROUP BY a.id HAVING COUNT(*) >= 100) old ON old.id = r.id;
+ALTER TABLE all_recent_games ADD COLUMN slot INT NOT NULL,
+                             ADD COLUMN seq BIGINT NOT NULL;
+UPDATE all_recent_games r
+  JOIN (SELECT a.id, COUNT(*) AS seq
+          FROM all_recent_games a JOIN all_recent_games b ON b.id <= a.id
+         GROUP BY a.id) n ON n.id = r.id
+   SET r.seq = n.seq, r.slot = MOD(n.seq, 100);
+CREATE UNIQUE INDEX all_recent_games_slot
+ON all_recent_games (slot);
+CREATE INDEX all_recent_games_seq
+ON all_recent_games (seq);
+
+DELETE r FROM player_recent_games r
+  JOIN (SELECT a.id
+          FROM player_recent_games a
+          JOIN player_recent_games b ON b.name = a.name AND b.id > a.id
+         GROUP BY a.id HAVING COUNT(*) >= 15) old ON old.id = r.id;
+ALTER TABLE player_recent_games ADD COLUMN slot INT NOT NULL,
+                                ADD COLUMN seq BIGINT NOT NULL;
+UPDATE player_recent_games r
+  JOIN (SELECT a.id, COUNT(*) AS seq
+          FROM player_recent_games a
+          JOIN player_recent_games b ON b.name = a.name AND b.id <= a.id
+         GROUP BY a.id) n ON n.id = r.id
+   SET r.seq = n.seq, r.slot = MOD(n.seq, 15);
+CREATE UNIQUE INDEX player_recent_games_name_slot
+ON player_recent_games (name, slot);
+CREATE INDEX player_recent_games_name_seq
+ON player_recent_games (name, seq);
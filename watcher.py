@@ -0,0 +1,146 @@
+# Waits for local logfiles to change, so that scoresd can pick up new games
+# as soon as they are written instead of on a fixed timer. Uses Linux
+# inotify (through ctypes, no extra modules needed); where inotify is not
+# available, falls back to polling the file sizes.
+
+import os
+import os.path
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+
+from logging import debug, info, warn, error
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVE_SELF = 0x00000800
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB
+              | IN_MOVE_SELF | IN_DELETE_SELF)
+
+# struct inotify_event: int wd; uint32 mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds between stats of the local files when polling.
+POLL_INTERVAL = 1
+
+def load_inotify():
+  """Returns libc if it has the inotify calls, otherwise None."""
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init
+    libc.inotify_add_watch
+    libc.inotify_rm_watch
+    return libc
+  except (OSError, AttributeError):
+    return None
+
+class ChangeWatcher:
+  """Tracks which of a set of local files have changed since the last call
+  to changed()."""
+  def __init__(self, filenames):
+    self.filenames = list(filenames)
+    self.pending = set()
+    self.libc = load_inotify()
+    self.fd = None
+    self.watches = { }
+    if self.libc:
+      fd = self.libc.inotify_init()
+      if fd >= 0:
+        self.fd = fd
+      else:
+        warn("inotify_init failed (errno %d), polling logfiles instead"
+             % ctypes.get_errno())
+    if self.fd is None:
+      self.sizes = dict([ (f, self._size(f)) for f in self.filenames ])
+    else:
+      for f in self.filenames:
+        self._watch(f)
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def _size(self, filename):
+    try:
+      return os.path.getsize(filename)
+    except OSError:
+      return None
+
+  def _watch(self, filename):
+    """Adds an inotify watch on filename (following symlinks). Files that
+    don't exist yet are retried on every wait() until they appear."""
+    wd = self.libc.inotify_add_watch(self.fd, filename, WATCH_MASK)
+    if wd < 0:
+      return False
+    self.watches[wd] = filename
+    return True
+
+  def _unwatched(self):
+    watched = set(self.watches.values())
+    return [ f for f in self.filenames if f not in watched ]
+
+  def wait(self, timeout):
+    """Blocks for up to timeout seconds, returning early as soon as any of
+    the files changes."""
+    if self.fd is None:
+      return self._poll(timeout)
+
+    for f in self._unwatched():
+      if self._watch(f):
+        # It appeared since we last looked.
+        self.pending.add(f)
+    if self.pending:
+      return
+
+    try:
+      ready = select.select([ self.fd ], [ ], [ ], max(timeout, 0))[0]
+    except select.error:
+      return
+    if ready:
+      self._read_events()
+
+  def _read_events(self):
+    buf = os.read(self.fd, 64 * 1024)
+    pos = 0
+    while pos + EVENT_HEADER.size <= len(buf):
+      wd, mask, cookie, namelen = EVENT_HEADER.unpack_from(buf, pos)
+      pos += EVENT_HEADER.size + namelen
+      filename = self.watches.get(wd)
+      if not filename:
+        continue
+      self.pending.add(filename)
+      if mask & (IN_IGNORED | IN_MOVE_SELF | IN_DELETE_SELF):
+        # Rotated or removed: watch whatever takes its place, now if it is
+        # already there, or from wait() once it appears. A moved file keeps
+        # its watch until we remove it.
+        del self.watches[wd]
+        if mask & IN_MOVE_SELF:
+          self.libc.inotify_rm_watch(self.fd, wd)
+        self._watch(filename)
+
+  def _poll(self, timeout):
+    deadline = time.time() + timeout
+    while True:
+      for f in self.filenames:
+        size = self._size(f)
+        if size != self.sizes.get(f):
+          self.sizes[f] = size
+          self.pending.add(f)
+      remaining = deadline - time.time()
+      if self.pending or remaining <= 0:
+        return
+      time.sleep(min(POLL_INTERVAL, remaining))
+
+  def changed(self):
+    """Returns the set of files changed since the last call."""
+    changed = self.pending
+    self.pending = set()
+    return changed